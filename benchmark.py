@@ -0,0 +1,329 @@
+#!/usr/bin/python3
+
+from typing import Dict, List
+from mininet.net import Mininet
+from mininet.log import setLogLevel
+from tester import Intersection
+import argparse
+import json
+import os
+import re
+import sys
+import threading
+import time
+
+# Used for parsing Iperf UDP server output. Captures interval end, bitrate,
+# bitrate unit, lost datagrams and total datagrams.
+IPERF_UDP_REGEX = r'\[\s*\d+\]\s+0\.00\-([\d\.]+)\s+sec\s+[\d\.]+ \w?Bytes' \
+                  r'\s+([\d\.]+) (\w?)bits\/sec\s+[\d\.]+ ms\s+(\d+)\/(\d+)'
+BITRATE_UNITS = {'': 1e-6, 'K': 1e-3, 'M': 1, 'G': 1e3}  # To Mbps
+
+# Process names are truncated to 15 characters in /proc/PID/stat
+PROCESS_GROUPS = {
+    'daemon': 'weighted_tunnel',
+    'ovs': 'ovs-vswitchd',
+    'iperf': 'iperf3',
+}
+MODES = ('none', 'daemon', 'consolidated')
+
+# A result is only compared against a baseline with the same settings
+RUN_KEYS = ('hosts', 'mode', 'bw', 'duration')
+
+# Metrics compared against the baseline. True if higher is better.
+METRICS = {
+    'throughput_mbps': True,
+    'pps': True,
+    'loss_pct': False,
+    'cpu_daemon': False,
+    'cpu_ovs': False,
+    'cpu_iperf': False,
+    'rss_daemon_kb': False,
+}
+
+# ==============================================================================
+# CPU SAMPLING
+# ==============================================================================
+
+
+def get_process_stats() -> Dict[int, tuple]:
+    """
+    Returns a dictionary mapping the PID of every process in PROCESS_GROUPS
+    to (group, cpu_seconds, rss_kb). cpu_seconds is user + system time.
+    """
+    ticks = os.sysconf('SC_CLK_TCK')
+    names = {v: k for k, v in PROCESS_GROUPS.items()}
+    stats = {}
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit():
+            continue
+        try:
+            with open(f'/proc/{pid}/stat') as f:
+                stat = f.read()
+        except OSError:
+            continue
+        # Name is in parentheses and may contain spaces
+        name = stat[stat.index('(') + 1:stat.rindex(')')]
+        if name not in names:
+            continue
+        fields = stat[stat.rindex(')') + 2:].split()
+        # utime and stime are fields 14 and 15, rss (pages) is field 24
+        cpu = (int(fields[11]) + int(fields[12])) / ticks
+        rss = int(fields[21]) * os.sysconf('SC_PAGE_SIZE') // 1024
+        stats[int(pid)] = (names[name], cpu, rss)
+    return stats
+
+
+class CpuSampler:
+    """
+    Samples the CPU time of daemons, ovs-vswitchd and iperf once per second.
+    Processes that exit between samples (like finished iperf clients) keep
+    the CPU time of their last sample.
+    """
+    def __init__(self, period: float = 1.0):
+        self.period = period
+        self.first = {}
+        self.last = {}
+        self.max_rss = {group: 0 for group in PROCESS_GROUPS}
+        self.sampled = False
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def sample(self) -> None:
+        """ Records the current CPU time of every tracked process. """
+        stats = get_process_stats()
+        for pid, (group, cpu, rss) in stats.items():
+            # Processes started after the first sample count from zero
+            self.first.setdefault(pid, (group, 0 if self.sampled else cpu))
+            self.last[pid] = (group, cpu)
+        rss = {group: 0 for group in PROCESS_GROUPS}
+        for group, _, r in stats.values():
+            rss[group] += r
+        for group in rss:
+            self.max_rss[group] = max(self.max_rss[group], rss[group])
+        self.sampled = True
+
+    def run(self) -> None:
+        """ Samples until stop is called. """
+        while not self.stop_event.wait(self.period):
+            self.sample()
+
+    def start(self) -> None:
+        """ Takes the initial sample and starts sampling in the background. """
+        self.sample()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self) -> Dict[str, float]:
+        """
+        Takes a final sample, stops sampling and returns the CPU seconds used
+        by each process group while sampling.
+        """
+        self.stop_event.set()
+        self.thread.join()
+        self.sample()
+        used = {group: 0.0 for group in PROCESS_GROUPS}
+        for pid, (group, cpu) in self.last.items():
+            used[group] += cpu - self.first[pid][1]
+        return used
+
+# ==============================================================================
+# RESULTS
+# ==============================================================================
+
+
+def parse_iperf_servers(
+    num_hosts: int, out_dir: str, iperf_duration: int
+) -> Dict[str, float]:
+    """
+    Returns total throughput (Mbps), packets per second, loss percentage and
+    successful connection count across all iperf servers in out_dir.
+    """
+    throughput, packets, lost, worked = 0.0, 0, 0, 0
+    for source in range(num_hosts):
+        for dest in range(num_hosts):
+            if source == dest:
+                continue
+            try:
+                with open(f'{out_dir}/s_h{source}-h{dest}.txt') as f:
+                    found = re.findall(IPERF_UDP_REGEX, f.read())
+            except OSError:
+                continue
+            if not found:
+                continue
+            # The summary line covers the longest interval starting at 0
+            end, rate, unit, n_lost, n_total = \
+                max(found, key=lambda b: float(b[0]))
+            if float(end) < iperf_duration * .9:
+                continue
+            worked += 1
+            throughput += float(rate) * BITRATE_UNITS[unit]
+            packets += int(n_total)
+            lost += int(n_lost)
+    return {
+        'throughput_mbps': throughput,
+        'pps': packets / iperf_duration,
+        'loss_pct': 100 * lost / packets if packets else 0.0,
+        'successes': worked,
+    }
+
+
+def compare_results(
+    results: List[Dict[str, object]],
+    baseline: List[Dict[str, object]],
+    tolerance: float = .1,
+    loss_tolerance: float = 1.0,
+) -> List[str]:
+    """
+    Compares results against a baseline run with the same hosts, mode,
+    bandwidth and duration. Returns a message for every metric that regressed
+    by more than tolerance (relative) or, for loss, more than loss_tolerance
+    percentage points, and for every result without a matching baseline.
+    """
+    regressions = []
+    base = {tuple(b.get(k) for k in RUN_KEYS): b for b in baseline}
+    for r in results:
+        b = base.get(tuple(r[k] for k in RUN_KEYS))
+        if b is None:
+            regressions.append(
+                f'{r["hosts"]} hosts, {r["mode"]}: no baseline with bw '
+                f'{r["bw"]} and duration {r["duration"]}'
+            )
+            continue
+        for metric, higher_is_better in METRICS.items():
+            if metric not in r or metric not in b:
+                continue
+            new, old = r[metric], b[metric]
+            if metric == 'loss_pct':
+                worse = new - old > loss_tolerance
+            elif higher_is_better:
+                worse = new < old * (1 - tolerance)
+            else:
+                worse = new > old * (1 + tolerance) and new - old > 1e-2
+            if worse:
+                regressions.append(
+                    f'{r["hosts"]} hosts, {r["mode"]}: {metric} '
+                    f'{old:.3f} -> {new:.3f}'
+                )
+    return regressions
+
+# ==============================================================================
+# BENCHMARK
+# ==============================================================================
+
+
+def run_benchmark(
+    num_hosts: int,
+    mode: str,
+    num_central_switches: int = 3,
+    iperf_duration: int = 30,
+    bw: str = '1000M',
+    out_dir: str = './iperf_results',
+) -> Dict[str, object]:
+    """
+    Runs the Intersection iperf test once and returns its metrics.
+
+    params:
+        num_hosts: Hosts in the Intersection topology.
+        mode: "none" for stock Mininet, "daemon" for one daemon per host or
+              "consolidated" for one daemon serving every host.
+        num_central_switches: Central switches (tunnels) in the topology.
+        iperf_duration: Seconds each iperf client runs.
+        bw: Iperf client bandwidth.
+        out_dir: Directory for iperf output.
+    """
+    assert mode in MODES, f'Mode must be one of {MODES}!'
+    os.system('mn -c')
+    os.system(f'rm {out_dir}/*.txt')
+    # A daemon left over from an earlier run would be counted in this one
+    leftover = [pid for pid, (group, _, _) in get_process_stats().items()
+                if group == 'daemon']
+    assert not leftover, f'Daemons still running before benchmark: {leftover}'
+    topo = Intersection(num_hosts, num_central_switches)
+    net = Mininet(topo)
+    net.start()
+    topo.add_flows(net)
+    if mode != 'none':
+        topo.start_daemon(net, consolidated=mode == 'consolidated')
+
+    sampler = CpuSampler()
+    sampler.start()
+    start = time.time()
+    topo.run_iperfs(
+        net, out_dir=out_dir, iperf_duration=iperf_duration, bw=bw
+    )
+    time.sleep(iperf_duration + 10)
+    cpu = sampler.stop()
+    elapsed = time.time() - start
+
+    for j in range(num_hosts):
+        net.get(f'h{j}').cmd('pkill iperf')
+    net.stop()
+    topo.stop_daemon()
+
+    result = {
+        'hosts': num_hosts,
+        'mode': mode,
+        'bw': bw,
+        'duration': iperf_duration,
+        'elapsed': elapsed,
+    }
+    result.update(parse_iperf_servers(num_hosts, out_dir, iperf_duration))
+    for group, seconds in cpu.items():
+        result[f'cpu_{group}'] = seconds
+    result['rss_daemon_kb'] = sampler.max_rss['daemon']
+    return result
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        description='Measures the CPU and packet rate overhead of Weighted '
+                    'Tunnels on the Intersection topology.'
+    )
+    parser.add_argument('--hosts', type=int, nargs='+', default=[2, 4, 8])
+    parser.add_argument('--modes', nargs='+', default=list(MODES),
+                        choices=MODES)
+    parser.add_argument('--duration', type=int, default=30)
+    parser.add_argument('--bw', default='1000M')
+    parser.add_argument('--results', default='benchmark_results.json')
+    parser.add_argument('--baseline', default='benchmark_baseline.json')
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='Store these results as the new baseline.')
+    parser.add_argument('--tolerance', type=float, default=.1,
+                        help='Relative change counted as a regression.')
+    args = parser.parse_args()
+
+    for path in ['flow_weights', 'iperf_results']:
+        if not os.path.exists(path):
+            os.mkdir(path)
+    setLogLevel('info')
+
+    results = []
+    for num_hosts in args.hosts:
+        for mode in args.modes:
+            results.append(run_benchmark(
+                num_hosts, mode, iperf_duration=args.duration, bw=args.bw
+            ))
+            with open(args.results, 'w') as f:
+                json.dump(results, f, indent=2)
+    os.system('mn -c')
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f'Saved baseline to {args.baseline}')
+        return 0
+    if not os.path.exists(args.baseline):
+        print(f'No baseline at {args.baseline}. Run with --save-baseline.')
+        return 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    regressions = compare_results(results, baseline, args.tolerance)
+    for r in regressions:
+        print(f'REGRESSION: {r}')
+    if not regressions:
+        print('No regressions against baseline.')
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
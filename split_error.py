@@ -0,0 +1,158 @@
+#!/usr/bin/python3
+
+from typing import Dict, List, Sequence
+from weighted_tunnels import HASH_TABLE_BITS, MAX_TUNNELS_PER_FLOW
+from weighted_tunnels import TRACE_OUTGOING
+import random
+
+HASH_TABLE_SIZE = 1 << HASH_TABLE_BITS
+
+# ==============================================================================
+# SCHEDULERS. Must match weighted_tunnels.c!!
+# ==============================================================================
+
+
+def hash32(key: int) -> int:
+    """ MurmurHash3 finalizer, as used by the daemon's hash mode. """
+    key &= 0xFFFFFFFF
+    key ^= key >> 16
+    key = (key * 0x85ebca6b) & 0xFFFFFFFF
+    key ^= key >> 13
+    key = (key * 0xc2b2ae35) & 0xFFFFFFFF
+    key ^= key >> 16
+    return key
+
+
+def deficit_picks(weights: Sequence[float], num_packets: int) -> List[int]:
+    """
+    Returns the tunnels the daemon's deficit scheduler (pick_next_bucket)
+    picks for num_packets packets.
+    """
+    allocs = [0.0] * len(weights)
+    picks = []
+    for _ in range(num_packets):
+        candidates = [i for i, w in enumerate(weights) if w > 0]
+        if not candidates:
+            picks.append(0)
+            continue
+        best = min(candidates, key=lambda i: (allocs[i], i))
+        low = allocs[best]
+        allocs = [a - low for a in allocs]
+        allocs[best] += 1 / weights[best]
+        picks.append(best)
+    return picks
+
+
+def build_hash_table(weights: Sequence[float]) -> List[int]:
+    """ Returns the daemon's hash mode lookup table for one destination. """
+    allocs = [0.0] * len(weights)
+    table = []
+    candidates = [i for i, w in enumerate(weights) if w > 0]
+    if not candidates:
+        return [0] * HASH_TABLE_SIZE
+    for _ in range(HASH_TABLE_SIZE):
+        best = min(candidates, key=lambda i: (allocs[i], i))
+        allocs[best] += 1 / weights[best]
+        table.append(best)
+    return table
+
+
+def hash_picks(weights: Sequence[float], keys: Sequence[int]) -> List[int]:
+    """
+    Returns the tunnels the daemon's hash mode (pick_hashed_bucket) picks for
+    packets with the given keys.
+    """
+    table = build_hash_table(weights)
+    return [table[hash32(k) & (HASH_TABLE_SIZE - 1)] for k in keys]
+
+# ==============================================================================
+# SPLIT ERROR
+# ==============================================================================
+
+
+def split_error(picks: Sequence[int], weights: Sequence[float]) -> float:
+    """
+    Returns the largest difference between the fraction of packets a tunnel
+    received and its fraction of the total weight. Tunnels beyond the end of
+    weights, such as trailing zero weights left off, have zero weight.
+    """
+    num_tunnels = max([len(weights)] + [p + 1 for p in picks])
+    weights = list(weights) + [0] * (num_tunnels - len(weights))
+    counts = [0] * num_tunnels
+    for p in picks:
+        counts[p] += 1
+    total = sum(weights)
+    return max(abs(c / len(picks) - w / total)
+               for c, w in zip(counts, weights))
+
+
+def compare_split_error(
+    weights: Sequence[float],
+    packet_counts: Sequence[int] = (10, 100, 1000, 10000, 100000),
+    trials: int = 20,
+    key_bits: int = 32,
+    seed: int = 0,
+) -> List[Dict[str, float]]:
+    """
+    Compares the split error of the deficit scheduler and hash mode for one
+    flow. Hash keys are consecutive, like the iperf3 sequence numbers hashed
+    by the seq and seq64 modes (key_bits=32) or IP IDs (key_bits=16), from a
+    random start for each trial.
+
+    Returns one dictionary per packet count with keys "packets", "deficit",
+    "hash_mean" and "hash_max".
+    """
+    assert len(weights) <= MAX_TUNNELS_PER_FLOW, 'Too many tunnels!'
+    rng = random.Random(seed)
+    mask = (1 << key_bits) - 1
+    results = []
+    for n in packet_counts:
+        errors = []
+        for _ in range(trials):
+            start = rng.getrandbits(key_bits)
+            keys = [(start + i) & mask for i in range(n)]
+            errors.append(split_error(hash_picks(weights, keys), weights))
+        results.append({
+            'packets': n,
+            'deficit': split_error(deficit_picks(weights, n), weights),
+            'hash_mean': sum(errors) / trials,
+            'hash_max': max(errors),
+        })
+    return results
+
+
+def trace_split_error(
+    trace: Dict[str, Sequence[int]],
+    dest_host: int,
+    weights: Sequence[float],
+) -> float:
+    """
+    Returns the split error actually achieved by a daemon for outgoing
+    packets to dest_host, from a read_trace result.
+    """
+    picks = [t for t, h, d in zip(
+        trace['tunnel'], trace['host'], trace['direction']
+    ) if h == dest_host and d == TRACE_OUTGOING]
+    return split_error(picks, weights)
+
+
+if __name__ == '__main__':
+    file = 'split_results.txt'
+    with open(file, 'w') as f:
+        f.write('\t'.join([
+            'Weights',
+            'Key',
+            '# Packets',
+            'Deficit error',
+            'Hash mean error',
+            'Hash max error'
+        ]))
+    for weights in ([.3, .7], [1, 1, 1], [.82, .14, .22], [5, 6, 7, 1]):
+        for key, bits in (('seq', 32), ('id', 16)):
+            for r in compare_split_error(weights, key_bits=bits):
+                line = f'{weights}\t{key}\t{r["packets"]}\t' \
+                       f'{r["deficit"]:.5f}\t{r["hash_mean"]:.5f}\t' \
+                       f'{r["hash_max"]:.5f}'
+                print(line)
+                with open(file, 'a') as f:
+                    f.write('\n' + line)
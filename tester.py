@@ -5,9 +5,13 @@ from mininet.topo import Topo
 from mininet.log import setLogLevel
 from weighted_tunnels import add_flow_tunnel, get_iperf_commands, add_flow_to_host
 from weighted_tunnels import start_daemon, set_tunnel_weights
+from weighted_tunnels import start_consolidated_daemon
+from weighted_tunnels import stop_consolidated_daemon
+from weight_controller import WeightController
 import os
 import time
 import re
+import types
 
 # Used for parsing Iperf server output in Mbps
 IPERF_BW_REGEX = r'\[  \d\]\s*0.\d+\s*\-\s*([\d\.]+).*?([\d\.]+) Mbits\/sec'
@@ -24,6 +28,7 @@ class Intersection(Topo):
         self.num_hosts = num_hosts
         self.num_central_switches = num_central_switches
         self.streams = []
+        self.daemon = None  # Consolidated daemon process, if running
         super().__init__(*args)  # This calls build!
 
     def build(self) -> None:
@@ -82,15 +87,32 @@ class Intersection(Topo):
             print(cmd)
             os.system(cmd)
 
-    def start_daemon(self, net: Mininet) -> None:
-        """ Weights tunnels for all hosts in this topology"""
+    def start_daemon(self, net: Mininet, consolidated: bool = False) -> None:
+        """
+        Weights tunnels for all hosts in this topology. If consolidated is
+        set, one daemon serves every host instead of one daemon per host.
+        """
+        if consolidated:
+            self.daemon = start_consolidated_daemon(
+                net=net, host_nums=list(range(self.num_hosts))
+            )
         for i in range(self.num_hosts):
-            start_daemon(net=net, host_num=i)
+            if not consolidated:
+                start_daemon(net=net, host_num=i)
             set_tunnel_weights(
                 i, [[1] * self.num_central_switches] * (self.num_hosts - 1)
             )
         time.sleep(1)
 
+    def stop_daemon(self) -> None:
+        """
+        Stops the consolidated daemon started by start_daemon, if any.
+        Per-host daemons are stopped with their hosts by net.stop().
+        """
+        if self.daemon is not None:
+            stop_consolidated_daemon(self.daemon)
+            self.daemon = None
+
     def run_iperfs(
         self, net: Mininet,
         out_dir: str,
@@ -203,6 +225,89 @@ def bw_test():
                 f.write(f'\t{avg_bw}\t{num_passed}\t')
 
 
+def controller_test():
+    """
+    Compares the bandwidth achieved with skewed static weights against the
+    same starting weights adjusted by a WeightController.
+    """
+    num_hosts, num_central = 4, 3
+    skewed = [1, .2, .05]  # Most traffic on the first central switch
+    file = 'controller_results.txt'
+    with open(file, 'w') as f:
+        f.write('\t'.join([
+            'Weights',
+            'Avg BW',
+            'Successes',
+            'Decisions'
+        ]))
+
+    for goal in [None, 'balance', 'min_max']:
+        topo = Intersection(num_hosts, num_central)
+        net = Mininet(topo)
+        net.start()
+        topo.add_flows(net)
+        topo.start_daemon(net)
+        weights = {}
+        for i in range(num_hosts):
+            weights[i] = [[] if j == i else list(skewed)
+                          for j in range(num_hosts)]
+            set_tunnel_weights(i, weights[i], dummy_self_row=False)
+        time.sleep(1)
+
+        controller = None
+        if goal is not None:
+            controller = WeightController(
+                net,
+                switch_nums=list(range(num_hosts + num_central)),
+                host_nums=list(range(num_hosts)),
+                goal=goal,
+                initial_weights=weights,
+                log_path=f'./iperf_results/controller_{goal}.txt',
+            )
+            controller.start()
+        topo.run_iperfs(
+            net, out_dir='./iperf_results', iperf_duration=30, bw='1000M'
+        )
+        for j in range(40, -1, -1):
+            print(j)
+            time.sleep(1)
+        if controller is not None:
+            controller.stop()
+        for j in range(num_hosts):
+            net.get(f'h{j}').cmd('pkill iperf')
+        net.stop()
+        try:
+            avg_bw, num_passed = topo.parse_output('./iperf_results', 30)
+        except:
+            avg_bw, num_passed = -1, -1
+        num_decisions = len(controller.decisions) if controller else 0
+        with open(file, 'a') as f:
+            f.write(f'\n{goal or "static"}\t{avg_bw}\t{num_passed}'
+                    f'\t{num_decisions}')
+        os.system('mn -c')
+
+
+def controller_convergence_test(max_updates: int = 50) -> None:
+    """
+    Checks that every controller goal settles instead of oscillating. Runs
+    without Mininet: each tunnel's cost is simply proportional to its share
+    of the flow's weight, as if every tunnel crossed one equal link.
+    """
+    no_net = types.SimpleNamespace(hosts=[])
+    for goal in ['balance', 'min_max']:
+        for weights in ([1, .2, .05], [.3, .7], [5, 1, 1, 1]):
+            controller = WeightController(no_net, [], [], goal=goal)
+            for i in range(max_updates):
+                costs = [w / sum(weights) for w in weights]
+                new = controller.new_weights(weights, costs)
+                if new == weights:
+                    break
+                weights = new
+            assert new == weights, \
+                f'{goal} did not settle after {max_updates} updates!'
+            print(f'{goal} settled after {i} updates on {weights}')
+
+
 def weight_test():
     """
     Function for testing proper weighting. Check the number of packets that
@@ -283,6 +388,8 @@ if __name__ == '__main__':
             os.mkdir(path)
     # Tell mininet to print useful information
     setLogLevel('info')
+    # Controller convergence test
+    controller_convergence_test()
     # Weight test
     os.system('mn -c')
     os.system('rm iperf_results/*.txt')
@@ -291,3 +398,7 @@ if __name__ == '__main__':
     os.system('mn -c')
     os.system('rm iperf_results/*.txt')
     bw_test()
+    # Controller test
+    os.system('mn -c')
+    os.system('rm iperf_results/*.txt')
+    controller_test()
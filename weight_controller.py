@@ -0,0 +1,377 @@
+from typing import Dict, List, Tuple
+from mininet.net import Mininet
+from weighted_tunnels import set_tunnel_weights, s
+from weighted_tunnels import MAX_TUNNELS_PER_FLOW, MAX_FLOWS
+from weighted_tunnels import DEFAULT_SEND_START_PORT
+from weighted_tunnels import FLOW_WEIGHTS_DIR, OVS15_CALL
+import json
+import os
+import re
+import threading
+import time
+
+# Used for parsing ovs-ofctl dump-flows and dump-ports output
+FLOW_PACKETS_REGEX = r'n_packets=(\d+)'
+FLOW_BYTES_REGEX = r'n_bytes=(\d+)'
+FLOW_SRC_REGEX = r'nw_src=([\d\.]+)'
+FLOW_DST_REGEX = r'nw_dst=([\d\.]+)'
+FLOW_SPORT_REGEX = r'(?:udp_src|tp_src)=(\d+)'
+FLOW_OUTPUT_REGEX = r'output:"?([^",\s]+)"?'
+PORT_STATS_REGEX = r'port\s+"?([^":\s]+)"?:\s*rx pkts=\d+, bytes=\d+, ' \
+                   r'drop=\d+[^\n]*\n\s*tx pkts=(\d+), bytes=(\d+), drop=(\d+)'
+
+GOALS = ('balance', 'min_max')
+
+# ==============================================================================
+# OPEN VSWITCH STATISTICS
+# ==============================================================================
+
+
+def get_flow_stats(switch_num: int) -> List[Dict[str, object]]:
+    """
+    Returns the statistics of every tunnel flow on a switch, as programmed by
+    add_flow_tunnel. Each flow is a dictionary with keys "packets", "bytes",
+    "nw_src", "nw_dst", "sport" and "port" (the output port).
+    """
+    flows = []
+    with os.popen(f'{OVS15_CALL} dump-flows {s(switch_num)}') as f:
+        for line in f.read().split('\n'):
+            found = [re.search(r, line) for r in (
+                FLOW_PACKETS_REGEX, FLOW_BYTES_REGEX, FLOW_SRC_REGEX,
+                FLOW_DST_REGEX, FLOW_SPORT_REGEX, FLOW_OUTPUT_REGEX
+            )]
+            if not all(found):
+                continue
+            packets, nbytes, src, dst, sport, port = [
+                m.group(1) for m in found
+            ]
+            flows.append({
+                'packets': int(packets),
+                'bytes': int(nbytes),
+                'nw_src': src,
+                'nw_dst': dst,
+                'sport': int(sport),
+                'port': port,
+            })
+    return flows
+
+
+def get_port_stats(switch_num: int) -> Dict[str, Tuple[int, int, int]]:
+    """
+    Returns a dictionary mapping each port on a switch to its
+    (tx_packets, tx_bytes, tx_dropped) counters.
+    """
+    with os.popen(f'{OVS15_CALL} dump-ports {s(switch_num)}') as f:
+        found = re.findall(PORT_STATS_REGEX, f.read())
+    return {p[0]: (int(p[1]), int(p[2]), int(p[3])) for p in found}
+
+# ==============================================================================
+# CONTROLLER
+# ==============================================================================
+
+
+class WeightController:
+    """
+    Closed-loop tunnel weight controller. Periodically samples per-tunnel load
+    and loss from the Open vSwitch flow and port statistics of the tunnels set
+    up by add_flow_tunnel, then recomputes each host's weights with
+    set_tunnel_weights.
+
+    A tunnel's cost is the load of the busiest link on its path, inflated by
+    the loss measured along the tunnel. Loss combines packets that reached
+    the tunnel's first hop but not its last with packets dropped at the
+    egress queue of any link on its path, which flow counters can't see. Links are assumed to have equal
+    capacity, so balancing load balances utilisation. Goals:
+        balance: Multiplicatively shifts weight towards cheaper tunnels until
+                 every tunnel of a flow has the same cost.
+        min_max: Moves weight from the most to the least costly tunnel of
+                 each flow, lowering the maximum link load. Each move is
+                 capped at the amount that would equalise the two tunnels if
+                 cost were proportional to weight, so it can't overshoot.
+
+    To keep weights from oscillating, costs are smoothed over samples, flows
+    whose tunnel costs are within deadband of each other are left alone, each
+    update moves at most max_step of a flow's total weight, and a flow is
+    held for hold_periods periods after each change.
+
+    Every change is recorded in self.decisions and appended to log_path as
+    one JSON object per line.
+    """
+    def __init__(
+        self,
+        net: Mininet,
+        switch_nums: List[int],
+        host_nums: List[int],
+        goal: str = 'balance',
+        period: float = 1.0,  # Seconds
+        max_step: float = .1,
+        deadband: float = .1,
+        hold_periods: int = 2,
+        smoothing: float = .5,
+        loss_penalty: float = 10,
+        min_weight: float = .01,
+        initial_weights: Dict[int, List[List[float]]] = None,
+        log_path: str = None,
+        send_start_port: int = DEFAULT_SEND_START_PORT,
+    ):
+        """
+        params:
+            net: Mininet network.
+            switch_nums: Switches to sample. Should include every switch
+                         that add_flow_tunnel programmed.
+            host_nums: Hosts whose weights are controlled. Each must have a
+                       daemon running.
+            goal: One of GOALS.
+            period: Seconds between samples.
+            max_step: Largest fraction of a flow's weight moved per update.
+            deadband: Flows whose largest and smallest tunnel costs differ by
+                      less than this fraction are not changed.
+            hold_periods: Periods a flow is left alone after a change.
+            smoothing: Weight of the previous sample in the exponentially
+                       weighted moving average of link loads.
+            loss_penalty: A tunnel's cost is multiplied by
+                          1 + loss_penalty * loss_rate.
+            min_weight: Smallest fraction of a flow given to any tunnel, so
+                        every tunnel keeps being measured.
+            initial_weights:
+                Starting weights for each host, formatted as for
+                set_tunnel_weights with a row for every host (use [] for the
+                host itself). Only tunnels with a positive starting weight
+                are used. If not given for a host, all tunnels found in the
+                switches are weighted equally.
+            log_path: File to append decisions to.
+            send_start_port: Start port for sender iperf sessions
+        """
+        assert goal in GOALS, f'Goal must be one of {GOALS}!'
+        self.net = net
+        self.switch_nums = switch_nums
+        self.host_nums = host_nums
+        self.goal = goal
+        self.period = period
+        self.max_step = max_step
+        self.deadband = deadband
+        self.hold_periods = hold_periods
+        self.smoothing = smoothing
+        self.loss_penalty = loss_penalty
+        self.min_weight = min_weight
+        self.initial_weights = initial_weights or {}
+        self.log_path = log_path or FLOW_WEIGHTS_DIR + '/controller_log.txt'
+        self.send_start_port = send_start_port
+
+        self.ip_to_host = {}
+        for host in net.hosts:
+            for intf in host.intfList():
+                if intf.IP():
+                    self.ip_to_host[intf.IP()] = int(host.name[1:])
+
+        self.paths = {}         # (src, dst, tunnel) -> [(switch, port), ...]
+        self.weights = {}       # src -> [[tunnel weights] for each dst]
+        self.link_loads = {}    # (switch, port) -> smoothed bytes/s
+        self.link_drops = {}    # (switch, port) -> tx drop rate
+        self.losses = {}        # (src, dst, tunnel) -> loss rate
+        self.held = {}          # (src, dst) -> periods left on hold
+        self.decisions = []
+        self.last_sample = None
+        self.last_time = None
+        self.thread = None
+        self.stop_event = threading.Event()
+
+    def sample(self) -> None:
+        """
+        Samples switch statistics. Updates tunnel paths, smoothed link loads,
+        link drop rates and per-tunnel loss rates since the previous sample.
+        """
+        now = time.time()
+        flows, ports = {}, {}
+        for switch in self.switch_nums:
+            for port, stats in get_port_stats(switch).items():
+                ports[(switch, port)] = stats
+            for flow in get_flow_stats(switch):
+                src = self.ip_to_host.get(flow['nw_src'])
+                offset = flow['sport'] - self.send_start_port
+                if src is None or \
+                        not 0 <= offset < MAX_FLOWS * MAX_TUNNELS_PER_FLOW:
+                    continue
+                key = (src, offset // MAX_TUNNELS_PER_FLOW,
+                       offset % MAX_TUNNELS_PER_FLOW)
+                flows.setdefault(key, {})[(switch, flow['port'])] = \
+                    flow['packets']
+
+        for key, hops in flows.items():
+            self.paths[key] = sorted(hops)
+
+        if self.last_sample is not None:
+            last_flows, last_ports = self.last_sample
+            dt = max(now - self.last_time, 1e-6)
+            for link, stats in ports.items():
+                if link not in last_ports:
+                    continue
+                rate = (stats[1] - last_ports[link][1]) / dt
+                old = self.link_loads.get(link, rate)
+                self.link_loads[link] = \
+                    self.smoothing * old + (1 - self.smoothing) * rate
+                tx = stats[0] - last_ports[link][0]
+                dropped = stats[2] - last_ports[link][2]
+                self.link_drops[link] = \
+                    dropped / (tx + dropped) if tx + dropped > 0 else 0
+            # Loss along a tunnel is the fraction of packets seen at its
+            # first hop that never reached its last hop, plus the packets
+            # its links dropped on transmit.
+            for key, hops in flows.items():
+                if key not in last_flows:
+                    continue
+                sent = [hops[hop] - last_flows[key].get(hop, 0)
+                        for hop in hops]
+                if max(sent) <= 0:
+                    continue
+                delivered = min(sent) / max(sent)
+                for hop in hops:
+                    delivered *= 1 - self.link_drops.get(hop, 0)
+                self.losses[key] = 1 - delivered
+
+        self.last_sample = (flows, ports)
+        self.last_time = now
+
+    def get_weights(self, src: int) -> List[List[float]]:
+        """
+        Returns the weights the controller is using for a host. The first
+        call starts from initial_weights or equal weights on every known
+        tunnel, and pushes them to the host's daemon.
+        """
+        if src not in self.weights:
+            num_hosts = max(self.ip_to_host.values()) + 1
+            weights = [list(w) for w in self.initial_weights.get(src, [])]
+            weights += [[] for _ in range(num_hosts - len(weights))]
+            for (s_, dst, tunnel) in self.paths:
+                if s_ != src or src in self.initial_weights or dst == src:
+                    continue
+                row = weights[dst]
+                row += [0] * (tunnel + 1 - len(row))
+                row[tunnel] = 1
+            self.weights[src] = weights
+            set_tunnel_weights(
+                src, [list(w) for w in weights], dummy_self_row=False
+            )
+        return self.weights[src]
+
+    def tunnel_cost(self, src: int, dst: int, tunnel: int) -> float:
+        """
+        Returns the load of the busiest link on a tunnel, inflated by the
+        tunnel's loss rate.
+        """
+        hops = self.paths.get((src, dst, tunnel), [])
+        load = max([self.link_loads.get(hop, 0) for hop in hops] + [0])
+        loss = self.losses.get((src, dst, tunnel), 0)
+        return load * (1 + self.loss_penalty * loss)
+
+    def new_weights(self, old: List[float], costs: List[float]) -> List[float]:
+        """
+        Returns rate limited weights for one flow given its current weights
+        and tunnel costs. Returns old unchanged if no change is needed.
+        """
+        active = [t for t, w in enumerate(old) if w > 0]
+        total = sum(old)
+        if len(active) < 2 or max(costs[t] for t in active) <= 0:
+            return old
+        cmax = max(costs[t] for t in active)
+        cmin = min(costs[t] for t in active)
+        if (cmax - cmin) / cmax < self.deadband:
+            return old
+
+        current = [w / total for w in old]
+        if self.goal == 'balance':
+            mean = sum(costs[t] * current[t] for t in active)
+            target = [0.0] * len(old)
+            for t in active:
+                target[t] = current[t] * mean / max(costs[t], mean * 1e-3)
+            norm = sum(target)
+            target = [w / norm for w in target]
+        else:  # min_max
+            worst = max(active, key=lambda t: costs[t])
+            best = min(active, key=lambda t: costs[t])
+            step = min(self.max_step, current[worst] * (1 - cmin / cmax) / 2)
+            target = list(current)
+            target[worst] -= step
+            target[best] += step
+
+        # Rate limit, then keep every active tunnel above min_weight
+        delta = [t - c for t, c in zip(target, current)]
+        moved = sum(abs(d) for d in delta) / 2
+        scale = min(1, self.max_step / moved) if moved else 0
+        new = [c + d * scale for c, d in zip(current, delta)]
+        for t in active:
+            new[t] = max(new[t], self.min_weight)
+        norm = sum(new)
+        return [round(w / norm * total, 6) for w in new]
+
+    def update(self) -> List[Dict[str, object]]:
+        """
+        Recomputes every host's weights from the latest sample and pushes the
+        ones that changed. Returns the decisions made.
+        """
+        decisions = []
+        for src in self.host_nums:
+            weights = self.get_weights(src)
+            changed = False
+            for dst, old in enumerate(weights):
+                if dst == src or not old:
+                    continue
+                if self.held.get((src, dst), 0) > 0:
+                    self.held[(src, dst)] -= 1
+                    continue
+                costs = [self.tunnel_cost(src, dst, t)
+                         for t in range(len(old))]
+                new = self.new_weights(old, costs)
+                if new == old:
+                    continue
+                weights[dst] = new
+                self.held[(src, dst)] = self.hold_periods
+                changed = True
+                decisions.append({
+                    'time': self.last_time,
+                    'src': src,
+                    'dst': dst,
+                    'goal': self.goal,
+                    'costs': costs,
+                    'losses': [self.losses.get((src, dst, t), 0)
+                               for t in range(len(old))],
+                    'old_weights': old,
+                    'new_weights': new,
+                })
+            if changed:
+                set_tunnel_weights(
+                    src, [list(w) for w in weights], dummy_self_row=False
+                )
+
+        if decisions:
+            with open(self.log_path, 'a') as f:
+                for d in decisions:
+                    f.write(json.dumps(d) + '\n')
+        self.decisions += decisions
+        return decisions
+
+    def step(self) -> List[Dict[str, object]]:
+        """ Samples statistics and, once rates are known, updates weights. """
+        self.sample()
+        if not self.link_loads:
+            return []
+        return self.update()
+
+    def run(self) -> None:
+        """ Runs the control loop until stop is called. """
+        while not self.stop_event.is_set():
+            self.step()
+            self.stop_event.wait(self.period)
+
+    def start(self) -> None:
+        """ Runs the control loop in a background thread. """
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self) -> None:
+        """ Stops the background control loop. """
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
@@ -1,10 +1,21 @@
+#define _GNU_SOURCE
 #include <stdio.h>
 #include <stdlib.h>
 #include <unistd.h>
+#include <errno.h>
+#include <time.h>
+#include <sched.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
+#include <fcntl.h>
+#include <stdint.h>
+#include <sys/socket.h>
+#include <sys/epoll.h>
 #include <netinet/in.h>
 #include <linux/types.h>
 #include <linux/netfilter.h>		/* for NF_ACCEPT */
 #include <linux/ip.h>
+#include <linux/netlink.h>
 #include <string.h>
 #include <argp.h>
 #include <stdbool.h>
@@ -26,19 +37,47 @@
 // Weights / cur allocs
 #define MAX_TUNNELS_PER_FLOW 16
 #define MAX_FLOWS 128
-double weights[MAX_FLOWS][MAX_TUNNELS_PER_FLOW];
-double curr_allocs[MAX_FLOWS][MAX_TUNNELS_PER_FLOW];
+#define MAX_HOSTS MAX_FLOWS // Hosts served by one consolidated daemon
+#define MAX_WORKERS 64
 
 // For message parsing
 // Assuming at most 32 characters per flow
 #define MAX_WEIGHT_MESSAGE_SIZE MAX_TUNNELS_PER_FLOW*MAX_FLOWS*32
-int weight_ready = 0;
 char message_buff[MAX_WEIGHT_MESSAGE_SIZE + 1];
-double weights_in_progress[MAX_FLOWS][MAX_TUNNELS_PER_FLOW];
 
 
 #define QUEUE_MAXLEN 65536 // 64k
 #define RECV_BUF_SIZE 16777216 // 16MB
+#define RECV_BATCH 64 // Packets read from one host's queue before moving to the next
+
+// Latency histogram. Bucket 0 holds 0ns, bucket i holds [2^(i-1), 2^i) ns.
+// MAKE SURE THIS IS THE SAME AS IN weighted_tunnels.py
+#define LATENCY_BUCKETS 40
+#define LATENCY_MAX_AGE_NS 1000000000ULL // Older kernel timestamps are rejected
+
+// Statistics files are rewritten once per second
+#define STATS_WRITE_PERIOD 10 // In weight polling periods (100ms)
+
+// Binary packet trace. MAKE SURE THESE ARE THE SAME AS IN weighted_tunnels.py
+#define TRACE_MAGIC "WTTRACE1"
+#define TRACE_DEFAULT_RECORDS 1048576 // 1M records, 24MB
+#define TRACE_OUTGOING 0
+#define TRACE_INCOMING 1
+
+// Stateless hash mode. MAKE SURE THESE ARE THE SAME AS IN weighted_tunnels.py
+#define HASH_TABLE_BITS 10
+#define HASH_TABLE_SIZE (1 << HASH_TABLE_BITS)
+#define HASH_NONE 0
+#define HASH_IP_ID 1
+#define HASH_SEQUENCE 2
+#define HASH_SEQUENCE64 3
+#define IPERF_SEQ_OFFSET 8 // Packet count in iperf3 UDP payloads
+
+// Tunnel statistics. iperf3 numbers each session's packets from 1 and
+// stamps each with its send time (seconds and microseconds at offset 0), so
+// a sequence number this close to 1 that was sent after the highest one
+// starts a new session. Reordered packets were sent before it.
+#define SEQ_RESTART_WINDOW 1024
 
 #define FAIL(msg) {fprintf(stderr, msg); return -1;}
 
@@ -52,11 +91,132 @@ int verbose = 0;
 int calc_checksum = 0;
 unsigned short queue_num = 58;
 char* weight_file = NULL;
+int cpu = -1;
+int fifo_priority = 0;
+int low_latency = 0;
+char* latency_file = NULL;
+char* trace_file = NULL;
+char* tunnel_stats_file = NULL;
+unsigned long trace_records = TRACE_DEFAULT_RECORDS;
+char* host_specs[MAX_HOSTS];
+int num_hosts = 0;
+int num_workers = 1;
+int hash_mode = HASH_NONE;
 
 // =================================================================================================
 // GLOBAL VARIABLES
 // =================================================================================================
-struct pkt_buff * pktb;
+__thread struct pkt_buff * pktb;
+
+// Latency instrumentation. Written by the packet thread, read by the weight thread.
+// buckets holds queue residence times measured from the kernel's timestamp.
+// Packets without a usable timestamp are timed from recv() instead, which
+// only covers the daemon's own processing, so they go in fallback_buckets.
+struct latency_stats
+{
+	unsigned long long packets;
+	unsigned long long no_kernel_timestamp;
+	unsigned long long bad_kernel_timestamp;
+	unsigned long long enobufs;
+	unsigned long long max_ns;
+	unsigned long long buckets[LATENCY_BUCKETS];
+	unsigned long long fallback_max_ns;
+	unsigned long long fallback_buckets[LATENCY_BUCKETS];
+};
+__thread struct timespec recv_time;
+
+// Per-tunnel counters. On the input path, out of order packets are ones that
+// arrive with a lower sequence number than one already received from the
+// same source. Reorder depth is how far behind that highest number they are.
+// Duplicates repeat the highest number; older duplicates can't be told apart
+// from reordered packets.
+struct tunnel_stats
+{
+	unsigned long long packets;
+	unsigned long long bytes;
+	unsigned long long out_of_order;
+	unsigned long long duplicates;
+	unsigned long long reorder_depth_sum;
+	unsigned long long reorder_depth_max;
+};
+struct flow_stats
+{
+	unsigned long long sequenced;    // Packets carrying an iperf3 sequence number
+	unsigned long long duplicates;
+	unsigned long long gaps;         // Jumps ahead by more than one sequence number
+	unsigned long long restarts;     // New iperf3 sessions after the first
+	unsigned long long prev_expected; // Sequence numbers spanned by earlier sessions
+	unsigned long long max_seq_sent_us; // iperf3 send time of max_seq
+	unsigned int first_seq;
+	unsigned int max_seq;
+	struct tunnel_stats tunnels[MAX_TUNNELS_PER_FLOW];
+};
+
+// Everything the daemon keeps for one Mininet host. A normal daemon serves a
+// single host. A consolidated daemon (-m) serves one per network namespace.
+// Each host is only touched by the worker thread that owns its queue and by
+// the weight thread, so hosts need no locking.
+struct host
+{
+	int index;
+	unsigned int ip;
+	char* weight_file;
+	char* netns;         // NULL to stay in the daemon's own namespace
+
+	// Weights / cur allocs
+	double weights[MAX_FLOWS][MAX_TUNNELS_PER_FLOW];
+	double curr_allocs[MAX_FLOWS][MAX_TUNNELS_PER_FLOW];
+	double weights_in_progress[MAX_FLOWS][MAX_TUNNELS_PER_FLOW];
+	int weight_ready;
+
+	// Hash mode lookup tables, only allocated in hash mode. The weight thread
+	// fills the inactive table then publishes it, so packet threads never
+	// write any shared state.
+	unsigned char (*hash_tables)[MAX_FLOWS][HASH_TABLE_SIZE];
+	unsigned char (*hash_table)[HASH_TABLE_SIZE];
+
+	// NetFilter queue
+	struct nfq_handle * h;
+	struct nfq_q_handle * qh;
+	int fd;
+
+	struct latency_stats latency;
+
+	// Tunnel statistics, only allocated with -R. recv is indexed by source
+	// host, sent by destination host.
+	struct flow_stats * recv;
+	struct tunnel_stats (*sent)[MAX_TUNNELS_PER_FLOW];
+};
+struct host * hosts = NULL;
+
+// Packet trace ring buffer, mmap'd from trace_file. There is a single writer
+// (the packet thread, so tracing needs a single worker). head counts every
+// record ever written and is published after the record it covers, so readers
+// can detect overwrites.
+struct trace_header
+{
+	char magic[8];
+	uint32_t record_size;
+	uint32_t unused;
+	uint64_t capacity;
+	uint64_t head;
+	uint8_t pad[32];
+};
+struct trace_record
+{
+	uint64_t timestamp_ns;
+	uint16_t host;       // Destination host (outgoing) or source host (incoming)
+	uint16_t orig_port;
+	uint16_t new_port;
+	uint16_t length;     // IP packet length
+	uint8_t direction;   // TRACE_OUTGOING or TRACE_INCOMING
+	uint8_t tunnel;
+	uint8_t protocol;
+	uint8_t node;        // Index of the daemon host that saw the packet
+	uint8_t pad[4];
+};
+struct trace_header * trace_hdr = NULL;
+struct trace_record * trace_ring = NULL;
 
 // =================================================================================================
 // PARSING USER ARGS
@@ -79,7 +239,7 @@ int parse_args(int argc, char **argv) {
 	// Parses command line arguments
 	int c;
 	extern char *optarg;
-	while ((c = getopt(argc, argv, "i:w:r:s:q:cvh")) != -1) {
+	while ((c = getopt(argc, argv, "i:w:m:j:r:s:q:a:f:H:t:T:x:R:lcvh")) != -1) {
 		switch (c) {
 		case 'i':
 			my_ip = (unsigned int) check_numeric_input(1L, 2147483647L, "Invalid integer for -i option: %s. IP should be given as an integer.\n");
@@ -87,6 +247,17 @@ int parse_args(int argc, char **argv) {
 		case 'w':
 			weight_file = optarg;
 			break;
+		case 'm':
+			if(num_hosts == MAX_HOSTS)
+			{
+				printf("Too many hosts! A consolidated daemon can serve at most %d hosts.\n", MAX_HOSTS);
+				return -1;
+			}
+			host_specs[num_hosts++] = optarg;
+			break;
+		case 'j':
+			num_workers = (int) check_numeric_input(1L, MAX_WORKERS, "Invalid integer for -j option: %s\n");
+			break;
 		case 'r':
 			recv_start_port = (unsigned short) check_numeric_input(1L, 65535L, "Invalid integer for -s option: %s\n");
 			break;
@@ -96,6 +267,37 @@ int parse_args(int argc, char **argv) {
 		case 'q':
 			queue_num = (unsigned short) check_numeric_input(0L, 255L, "Invalid integer for -q option: %s\n");
 			break;
+		case 'a':
+			cpu = (int) check_numeric_input(0L, CPU_SETSIZE - 1, "Invalid integer for -a option: %s\n");
+			break;
+		case 'f':
+			fifo_priority = (int) check_numeric_input(1L, 99L, "Invalid integer for -f option: %s\n");
+			break;
+		case 'H':
+			latency_file = optarg;
+			break;
+		case 'l':
+			low_latency = 1;
+			break;
+		case 't':
+			trace_file = optarg;
+			break;
+		case 'T':
+			trace_records = (unsigned long) check_numeric_input(1L, 1L << 30, "Invalid integer for -T option: %s\n");
+			break;
+		case 'R':
+			tunnel_stats_file = optarg;
+			break;
+		case 'x':
+			if(!strcmp(optarg, "id")) hash_mode = HASH_IP_ID;
+			else if(!strcmp(optarg, "seq")) hash_mode = HASH_SEQUENCE;
+			else if(!strcmp(optarg, "seq64")) hash_mode = HASH_SEQUENCE64;
+			else
+			{
+				printf("Invalid hash mode for -x option: %s. Use id, seq or seq64.\n", optarg);
+				return -1;
+			}
+			break;
 		case 'c':
 			calc_checksum = 1;
 			break;
@@ -104,25 +306,49 @@ int parse_args(int argc, char **argv) {
 			break;
 		case 'h':
 			printf("%s: TCP & UDP Port Spoofer\n", argv[0]);
-			printf("Usage: %s -i my_ip [-r recv_start_port] [-s send_start_port] [-q queue_num] [-c calc_checksum] [-v]\n", argv[0]);
+			printf("Usage: %s {-i my_ip -w weight_file | -m netns,ip,weight_file ... [-j workers]} [-r recv_start_port] [-s send_start_port] [-q queue_num] [-a cpu] [-f fifo_priority] [-H latency_file] [-t trace_file] [-T trace_records] [-x id|seq|seq64] [-R tunnel_stats_file] [-l] [-c calc_checksum] [-v]\n", argv[0]);
 			printf("\n");
 			printf("Options:\n");
-			printf("  -i my_ip=my_ip                Required. IP address of this device formatted as an integer.\n");
+			printf("  -i my_ip=my_ip                Required unless -m is given. IP address of this device formatted as an integer.\n");
 			printf("  -w weight_file=path           File with port weights. If it exists, will be read then deleted. Checked once per second.\n");
+			printf("  -m netns,ip,weight_file       Consolidated mode. Serve the host in network namespace netns (e.g. /proc/PID/ns/net)\n");
+			printf("                                with IP address ip and weight file weight_file. Repeat once per host. Replaces -i and -w.\n");
+			printf("  -j workers=workers            Consolidated mode worker threads. Hosts are split evenly between workers. Set to: %d.\n", num_workers);
 			printf("  -r recv_start_port=recv_start_port     The minimum port for iperf receivers. Set to: %d\n", recv_start_port);
 			printf("  -r send_start_port=send_start_port     The minimum port for iperf senders. Set to: %d. Must be > recv_start_port.\n", send_start_port);
 			printf("  -q queue_num=queue_num        NFQueue queue number to use. Set to: %d.\n", queue_num);
+			printf("  -a cpu=cpu                    Pin the packet thread to this CPU. Worker N is pinned to cpu + N.\n");
+			printf("  -f fifo_priority=priority     Run the packet thread under SCHED_FIFO with this priority (1-99).\n");
+			printf("  -H latency_file=path          Write a queue residence time histogram to this file once per second.\n");
+			printf("  -t trace_file=path            Write a binary record of each translated packet to a ring buffer in this file.\n");
+			printf("  -T trace_records=n            Number of records in the trace ring buffer. Set to: %lu.\n", trace_records);
+			printf("  -x hash_mode=id|seq|seq64     Stateless tunnel selection. Hashes the IP ID (id) or iperf3 UDP sequence number\n");
+			printf("                                (seq, or seq64 for iperf3 --udp-counters-64bit) through a weight-proportional\n");
+			printf("                                lookup table instead of the deficit scheduler.\n");
+			printf("  -R tunnel_stats_file=path     Count packets sent and received on each tunnel, and track loss and reordering\n");
+			printf("                                of iperf3 UDP flows (32 bit counters). Written to this file once per second.\n");
+			printf("  -l low_latency                Poll the queue without blocking, lock memory and ignore ENOBUFS.\n");
 			printf("  -c calculate_checksum         Calculate checksum for UDP & TCP packets. By default, checksum is set to 0.\n");
 			printf("  -v verbose                    Print the results of each packet.\n");
 			exit(0);
 			break;
 		case '?':
-			printf("Usage: %s -i my_ip [-r recv_start_port] [-s send_start_port] [-q queue_num] [-c calc_checksum] [-v]\n", argv[0]);
+			printf("Usage: %s {-i my_ip -w weight_file | -m netns,ip,weight_file ... [-j workers]} [-r recv_start_port] [-s send_start_port] [-q queue_num] [-a cpu] [-f fifo_priority] [-H latency_file] [-t trace_file] [-T trace_records] [-x id|seq|seq64] [-R tunnel_stats_file] [-l] [-c calc_checksum] [-v]\n", argv[0]);
 			return -1;
 			break;
 		}
 	}
-	if(my_ip == 0)
+	if(num_hosts && (my_ip || weight_file))
+	{
+		printf("-i and -w can't be used with -m! Give each host's IP and weight file with -m.\n");
+		return -1;
+	}
+	if(num_workers > 1 && trace_file)
+	{
+		printf("Tracing requires a single worker!\n");
+		return -1;
+	}
+	if(!num_hosts && my_ip == 0)
 	{
 		printf("Invalid IP and/or port!\n");
 		return -1;
@@ -137,7 +363,7 @@ int parse_args(int argc, char **argv) {
 		printf("Send start port too high! Send start port must be < 65535 - %d.\n", MAX_TUNNELS_PER_FLOW * MAX_FLOWS);
 		return -1;
 	}
-	if(!weight_file)
+	if(!num_hosts && !weight_file)
 	{
 		printf("No weight file given!\n");
 		return -1;
@@ -145,23 +371,279 @@ int parse_args(int argc, char **argv) {
 	printf("Intercepting packets on queue %d.\n", queue_num);
 	printf("Source ports %d <= sport <= %d will be modified.\n", send_start_port, send_start_port + MAX_FLOWS * MAX_TUNNELS_PER_FLOW);
 	printf("Iperf session from host M to host N should use source port %d + N and destination port %d + M.\n", send_start_port, recv_start_port);
-	printf("Packets from IP address %d are outgoing.\n", my_ip);
+	printf("Packets from the host's own IP address are outgoing.\n");
 	printf("	Source port %d + N will be mapped to %d + N * %d + Tunnel #. Destination port unchanged.\n", send_start_port, send_start_port, MAX_TUNNELS_PER_FLOW);
 	printf("Other packets are incoming.\n");
 	printf("	Source port %d + N * %d + Tunnel # will be mapped to %d + N. Destination port unchanged.\n", send_start_port, MAX_TUNNELS_PER_FLOW, send_start_port);
 	printf("Calculate checksum: %d\n", calc_checksum);
-	printf("Weight file: %s\n", weight_file);
+	if(!num_hosts) printf("IP address: %d\nWeight file: %s\n", my_ip, weight_file);
+	for(int i = 0; i < num_hosts; i++) printf("Host %d: %s\n", i, host_specs[i]);
+	printf("Workers: %d\n", num_workers);
+	printf("Hash mode: %d\n", hash_mode);
+	printf("Tunnel stats file: %s\n", tunnel_stats_file ? tunnel_stats_file : "(none)");
+	printf("CPU: %d\n", cpu);
+	printf("SCHED_FIFO priority: %d\n", fifo_priority);
+	printf("Low latency: %d\n", low_latency);
+	printf("Latency file: %s\n", latency_file ? latency_file : "(none)");
+	printf("Trace file: %s (%lu records)\n", trace_file ? trace_file : "(none)", trace_records);
 	printf("Verbose: %d\n", verbose);
 	return 0;
 }
 
+// =================================================================================================
+// LATENCY INSTRUMENTATION
+// =================================================================================================
+static inline unsigned long long timespec_ns(struct timespec * t)
+{
+	return t->tv_sec * 1000000000ULL + t->tv_nsec;
+}
+
+static inline void add_latency_sample(unsigned long long * buckets, unsigned long long * max_ns, unsigned long long ns)
+{
+	// Adds a sample to a log2 histogram. Bucket b holds 2^(b-1) <= ns < 2^b.
+	int bucket = ns ? 64 - __builtin_clzll(ns) : 0;
+	if(bucket >= LATENCY_BUCKETS) bucket = LATENCY_BUCKETS - 1;
+	buckets[bucket]++;
+	if(ns > *max_ns) *max_ns = ns;
+}
+
+void record_latency(struct host * host, struct nfq_data *nfad)
+{
+	// Records the queue residence time of a packet that has just received its
+	// verdict. Residence time is measured from the kernel's packet timestamp.
+	// Locally generated packets usually have none, and egress TCP packets may
+	// carry a CLOCK_MONOTONIC delivery time instead, so timestamps in the
+	// future or older than LATENCY_MAX_AGE_NS are rejected. Those packets are
+	// timed from when they were received from the queue socket instead and
+	// kept in a separate histogram.
+	struct timespec now;
+	struct timeval tv;
+	unsigned long long start, end;
+
+	clock_gettime(CLOCK_REALTIME, &now);
+	end = timespec_ns(&now);
+	host->latency.packets++;
+	if(nfq_get_timestamp(nfad, &tv) == 0 && (tv.tv_sec || tv.tv_usec))
+	{
+		start = tv.tv_sec * 1000000000ULL + tv.tv_usec * 1000ULL;
+		if(start <= end && end - start <= LATENCY_MAX_AGE_NS)
+		{
+			add_latency_sample(host->latency.buckets, &host->latency.max_ns, end - start);
+			return;
+		}
+		host->latency.bad_kernel_timestamp++;
+	}
+	else host->latency.no_kernel_timestamp++;
+	start = timespec_ns(&recv_time);
+	add_latency_sample(host->latency.fallback_buckets, &host->latency.fallback_max_ns, end > start ? end - start : 0);
+}
+
+void write_latency_stats()
+{
+	// Writes the latency histogram, summed over all hosts, to a temporary
+	// file, then moves it to latency_file so readers never see a partial write.
+	char tmp_path[4096];
+	FILE * f;
+	struct latency_stats latency;
+	bzero(&latency, sizeof(latency));
+	for(int h = 0; h < num_hosts; h++)
+	{
+		struct latency_stats * l = &hosts[h].latency;
+		latency.packets += l->packets;
+		latency.no_kernel_timestamp += l->no_kernel_timestamp;
+		latency.bad_kernel_timestamp += l->bad_kernel_timestamp;
+		latency.enobufs += l->enobufs;
+		if(l->max_ns > latency.max_ns) latency.max_ns = l->max_ns;
+		if(l->fallback_max_ns > latency.fallback_max_ns) latency.fallback_max_ns = l->fallback_max_ns;
+		for(int i = 0; i < LATENCY_BUCKETS; i++)
+		{
+			latency.buckets[i] += l->buckets[i];
+			latency.fallback_buckets[i] += l->fallback_buckets[i];
+		}
+	}
+	snprintf(tmp_path, sizeof(tmp_path), "%s.tmp", latency_file);
+	if(!(f = fopen(tmp_path, "w"))) return;
+	fprintf(f, "packets,%llu\n", latency.packets);
+	fprintf(f, "no_kernel_timestamp,%llu\n", latency.no_kernel_timestamp);
+	fprintf(f, "bad_kernel_timestamp,%llu\n", latency.bad_kernel_timestamp);
+	fprintf(f, "enobufs,%llu\n", latency.enobufs);
+	fprintf(f, "max_ns,%llu\n", latency.max_ns);
+	fprintf(f, "fallback_max_ns,%llu\n", latency.fallback_max_ns);
+	for(int i = 0; i < LATENCY_BUCKETS; i++)
+		fprintf(f, "bucket,%d,%llu\n", i, latency.buckets[i]);
+	for(int i = 0; i < LATENCY_BUCKETS; i++)
+		fprintf(f, "fallback_bucket,%d,%llu\n", i, latency.fallback_buckets[i]);
+	fclose(f);
+	rename(tmp_path, latency_file);
+}
+
+// =================================================================================================
+// PACKET TRACE
+// =================================================================================================
+int open_trace()
+{
+	// Creates trace_file and maps the ring buffer into memory.
+	size_t size = sizeof(struct trace_header) + trace_records * sizeof(struct trace_record);
+	int fd;
+	void * mem;
+	if((fd = open(trace_file, O_RDWR | O_CREAT | O_TRUNC, 0644)) < 0)
+		FAIL("Failed to open trace file.\n");
+	if(ftruncate(fd, size))
+	{
+		close(fd);
+		FAIL("Failed to size trace file.\n");
+	}
+	mem = mmap(NULL, size, PROT_READ | PROT_WRITE, MAP_SHARED, fd, 0);
+	close(fd);
+	if(mem == MAP_FAILED)
+		FAIL("Failed to map trace file.\n");
+	trace_hdr = (struct trace_header *) mem;
+	trace_ring = (struct trace_record *) (trace_hdr + 1);
+	memcpy(trace_hdr->magic, TRACE_MAGIC, sizeof(trace_hdr->magic));
+	trace_hdr->record_size = sizeof(struct trace_record);
+	trace_hdr->capacity = trace_records;
+	__atomic_store_n(&trace_hdr->head, 0, __ATOMIC_RELEASE);
+	return 0;
+}
+
+void trace_packet(struct host * host, unsigned int saddr, unsigned short sport, unsigned short new_sport,
+                  unsigned short dport, int length, unsigned char protocol)
+{
+	// Appends a record for a translated packet to the trace ring buffer.
+	struct timespec now;
+	uint64_t head = trace_hdr->head;
+	struct trace_record * r = &trace_ring[head % trace_records];
+
+	clock_gettime(CLOCK_REALTIME, &now);
+	r->timestamp_ns = timespec_ns(&now);
+	r->orig_port = sport;
+	r->new_port = new_sport;
+	r->length = length;
+	r->protocol = protocol;
+	r->node = host->index;
+	if(saddr == host->ip)
+	{
+		r->direction = TRACE_OUTGOING;
+		r->host = sport - send_start_port;
+		r->tunnel = (new_sport - send_start_port) % MAX_TUNNELS_PER_FLOW;
+	}
+	else
+	{
+		r->direction = TRACE_INCOMING;
+		r->host = dport >= recv_start_port && dport < recv_start_port + MAX_FLOWS ? dport - recv_start_port : 0xFFFF;
+		r->tunnel = (sport - send_start_port) % MAX_TUNNELS_PER_FLOW;
+	}
+	__atomic_store_n(&trace_hdr->head, head + 1, __ATOMIC_RELEASE);
+}
+
+// =================================================================================================
+// TUNNEL STATISTICS
+// =================================================================================================
+void count_tunnel_packet(struct host * host, unsigned int saddr, unsigned short sport, unsigned short new_sport,
+                         unsigned short dport, struct iphdr * ip_hdr, struct udphdr * udph, int length)
+{
+	// Counts a translated packet against its tunnel. For incoming iperf3 UDP
+	// packets, also tracks the flow's sequence numbers to find reordering.
+	struct tunnel_stats * t;
+	struct flow_stats * flow;
+	unsigned int header[3];          // iperf3 send seconds, microseconds and sequence number
+	unsigned int seq;
+	unsigned long long sent_us;
+	int header_size = ip_hdr->ihl * 4 + sizeof(struct udphdr);
+
+	if(saddr == host->ip)
+	{
+		unsigned short dnum = sport - send_start_port;
+		if(dnum >= MAX_FLOWS) return;
+		t = &host->sent[dnum][(new_sport - send_start_port) % MAX_TUNNELS_PER_FLOW];
+		t->packets++;
+		t->bytes += length;
+		return;
+	}
+	if(dport < recv_start_port || dport >= recv_start_port + MAX_FLOWS) return;
+	flow = &host->recv[dport - recv_start_port];
+	t = &flow->tunnels[(sport - send_start_port) % MAX_TUNNELS_PER_FLOW];
+	t->packets++;
+	t->bytes += length;
+
+	if(!udph || length < header_size + (int) sizeof(header)) return;
+	memcpy(header, udph + 1, sizeof(header));
+	sent_us = ntohl(header[0]) * 1000000ULL + ntohl(header[1]);
+	seq = ntohl(header[IPERF_SEQ_OFFSET / sizeof(header[0])]);
+	// Signed difference handles sequence number wraparound
+	int ahead = (int) (seq - flow->max_seq);
+	long long depth = -(long long) ahead;
+	if(!flow->sequenced || (depth >= 0 && seq <= SEQ_RESTART_WINDOW && sent_us > flow->max_seq_sent_us))
+	{
+		if(flow->sequenced)
+		{
+			flow->prev_expected += flow->max_seq - flow->first_seq + 1ULL;
+			flow->restarts++;
+		}
+		flow->first_seq = flow->max_seq = seq;
+		flow->max_seq_sent_us = sent_us;
+		flow->sequenced++;
+		return;
+	}
+	flow->sequenced++;
+	if(ahead > 0)
+	{
+		if(ahead > 1) flow->gaps++;
+		flow->max_seq = seq;
+		flow->max_seq_sent_us = sent_us;
+		return;
+	}
+	if(!ahead)
+	{
+		t->duplicates++;
+		flow->duplicates++;
+		return;
+	}
+	// The session's first packets may arrive out of order too
+	if((int) (seq - flow->first_seq) < 0) flow->first_seq = seq;
+	t->out_of_order++;
+	t->reorder_depth_sum += depth;
+	if((unsigned long long) depth > t->reorder_depth_max) t->reorder_depth_max = depth;
+}
+
+void write_tunnel_stats()
+{
+	// Writes every host's non-zero tunnel counters to a temporary file, then
+	// moves it to tunnel_stats_file so readers never see a partial write.
+	char tmp_path[4096];
+	FILE * f;
+	snprintf(tmp_path, sizeof(tmp_path), "%s.tmp", tunnel_stats_file);
+	if(!(f = fopen(tmp_path, "w"))) return;
+	for(int h = 0; h < num_hosts; h++) for(int n = 0; n < MAX_FLOWS; n++)
+	{
+		struct flow_stats * flow = &hosts[h].recv[n];
+		// Expected counts every sequence number each session spanned
+		if(flow->sequenced)
+			fprintf(f, "flow,%d,%d,%llu,%llu,%llu,%llu,%llu,%u,%u\n", h, n, flow->sequenced, flow->duplicates,
+			        flow->prev_expected + (flow->max_seq - flow->first_seq + 1ULL), flow->gaps, flow->restarts,
+			        flow->first_seq, flow->max_seq);
+		for(int i = 0; i < MAX_TUNNELS_PER_FLOW; i++)
+		{
+			struct tunnel_stats * r = &flow->tunnels[i];
+			struct tunnel_stats * s = &hosts[h].sent[n][i];
+			if(r->packets)
+				fprintf(f, "recv,%d,%d,%d,%llu,%llu,%llu,%llu,%llu,%llu\n", h, n, i, r->packets, r->bytes,
+				        r->out_of_order, r->duplicates, r->reorder_depth_sum, r->reorder_depth_max);
+			if(s->packets)
+				fprintf(f, "sent,%d,%d,%d,%llu,%llu\n", h, n, i, s->packets, s->bytes);
+		}
+	}
+	fclose(f);
+	rename(tmp_path, tunnel_stats_file);
+}
+
 // =================================================================================================
 // MESSAGE PARSING
 // =================================================================================================
-void parse_weight_message(char* lines[], int line_count)
+void parse_weight_message(struct host * host, char* lines[], int line_count)
 {
-	// Parses a weight message and fills in weights_in_progress
-	bzero(weights_in_progress, sizeof(weights_in_progress));
+	// Parses a weight message and fills in the host's weights_in_progress
+	bzero(host->weights_in_progress, sizeof(host->weights_in_progress));
 
 	// Get weights from subsequent lines
 	for(int i = 0; i < line_count; i++)
@@ -179,8 +661,8 @@ void parse_weight_message(char* lines[], int line_count)
 		while(j < MAX_TUNNELS_PER_FLOW)
 		{
 			if(!weight) break;
-			weights_in_progress[i][j++] = atof(weight);
-			if(verbose) printf("Destination host %d tunnel %d: Weight %lf\n", i, j - 1, weights_in_progress[i][j - 1]);
+			host->weights_in_progress[i][j++] = atof(weight);
+			if(verbose) printf("Destination host %d tunnel %d: Weight %lf\n", i, j - 1, host->weights_in_progress[i][j - 1]);
 			weight = strtok(NULL, ",");
 		}
 		if(strtok(NULL, ","))
@@ -191,59 +673,106 @@ void parse_weight_message(char* lines[], int line_count)
 	}
 }
 
-void* read_weights(void * unused)
+void build_hash_table(struct host * host)
+{
+	// Fills the host's inactive hash table from weights_in_progress, then
+	// publishes it. Each destination's table holds every tunnel in proportion
+	// to its weight, laid out by running the deficit scheduler over it.
+	unsigned char (*table)[HASH_TABLE_SIZE] = host->hash_table == host->hash_tables[0] ? host->hash_tables[1] : host->hash_tables[0];
+	double allocs[MAX_TUNNELS_PER_FLOW];
+	for(int d = 0; d < MAX_FLOWS; d++)
+	{
+		double * weights = host->weights_in_progress[d];
+		bzero(allocs, sizeof(allocs));
+		for(int k = 0; k < HASH_TABLE_SIZE; k++)
+		{
+			double min = 1e+300;
+			int min_ind = -1;
+			for(int i = 0; i < MAX_TUNNELS_PER_FLOW; i++)
+				if(allocs[i] < min && weights[i] > 0)
+				{
+					min_ind = i;
+					min = allocs[i];
+				}
+			if(min_ind == -1)
+			{
+				bzero(table[d], sizeof(table[d]));
+				break;
+			}
+			allocs[min_ind] += 1 / weights[min_ind];
+			table[d][k] = min_ind;
+		}
+	}
+	__atomic_store_n(&host->hash_table, table, __ATOMIC_RELEASE);
+}
+
+void read_weight_file(struct host * host)
 {
-	// Polls the weight file every 100ms. If one is written, reads and deletes
-	// it.
+	// Reads and deletes a host's weight file if one has been written.
 	FILE * f;
+	if(host->weight_ready || access(host->weight_file, F_OK)) return;
+	if(!(f = fopen(host->weight_file, "r"))) return;
+	int nread = fread(message_buff, sizeof(char), MAX_WEIGHT_MESSAGE_SIZE, f);
+	message_buff[nread] = '\0';
+	fclose(f);
+	remove(host->weight_file);
+	if(verbose) printf("Received new weights!\n%s\n", host->weight_file);
+
+	// Split by lines
+	char* lines[MAX_FLOWS + 1];
+	int line_count = 1;
+	lines[0] = message_buff;
+	for(int i = 0; i < nread; i++) if(message_buff[i] == '\n')
+	{
+		message_buff[i] = '\0';
+		lines[line_count++] = &(message_buff[i + 1]);
+		if(line_count == MAX_FLOWS) break;
+	}
+	// Parse lines
+	parse_weight_message(host, lines, line_count);
+	if(hash_mode) build_hash_table(host);
+	else host->weight_ready = 1;
+}
+
+void* read_weights(void * unused)
+{
+	// Polls every host's weight file every 100ms. If one is written, reads
+	// and deletes it.
+	int period = 0;
 	while(1)
 	{
-		// Read weight file
+		// Read weight files
 		if(verbose) printf(".\n");
 		usleep(100000);
-		if(weight_ready || access(weight_file, F_OK)) continue;
-		if(!(f = fopen(weight_file, "r"))) continue;
-		int nread = fread(message_buff, sizeof(char), MAX_WEIGHT_MESSAGE_SIZE, f);
-		message_buff[nread] = '\0';
-		fclose(f);
-		remove(weight_file);
-		if(verbose) printf("Received new weights!\n%s\n", weight_file);
-			
-		// Split by lines
-		char* lines[MAX_FLOWS + 1];
-		int line_count = 1;
-		lines[0] = message_buff;
-		for(int i = 0; i < nread; i++) if(message_buff[i] == '\n')
+		if(++period % STATS_WRITE_PERIOD == 0)
 		{
-			message_buff[i] = '\0';
-			lines[line_count++] = &(message_buff[i + 1]);
-			if(line_count == MAX_FLOWS) break;
+			if(latency_file) write_latency_stats();
+			if(tunnel_stats_file) write_tunnel_stats();
 		}
-		// Parse lines
-		parse_weight_message(lines, line_count);
-		weight_ready = 1;
+		for(int i = 0; i < num_hosts; i++) read_weight_file(&hosts[i]);
 	}
 }
 
 // =================================================================================================
 // PORT TRANSLATION
 // =================================================================================================
-unsigned short pick_next_bucket(unsigned short dnum)
+unsigned short pick_next_bucket(struct host * host, unsigned short dnum)
 {
 	// Picks a new destination bucket for destination "dnum".
+	double (*weights)[MAX_TUNNELS_PER_FLOW] = host->weights;
+	double (*curr_allocs)[MAX_TUNNELS_PER_FLOW] = host->curr_allocs;
 
 	// Get new weights if available
-	if(weight_ready)
+	if(host->weight_ready)
 	{
-		bzero(curr_allocs, sizeof(curr_allocs));
-		bcopy(weights_in_progress, weights, sizeof(weights));
-		weight_ready = 0;
+		bzero(host->curr_allocs, sizeof(host->curr_allocs));
+		bcopy(host->weights_in_progress, host->weights, sizeof(host->weights));
+		host->weight_ready = 0;
 	}
 
 	// Find next candidate
 	double min = 1e+300;
 	int min_ind = -1;
-	printf("Dnum: %d\n", dnum);
 	for(int i = 0; i < MAX_TUNNELS_PER_FLOW; i++)
 		if(curr_allocs[dnum][i] < min && weights[dnum][i] > 0)
 		{
@@ -263,10 +792,47 @@ unsigned short pick_next_bucket(unsigned short dnum)
 	return min_ind;
 }
 
-unsigned short port_translate(unsigned short sport, unsigned int saddr)
+static inline unsigned int hash32(unsigned int key)
+{
+	// MurmurHash3 finalizer. Spreads sequential keys evenly over the table.
+	key ^= key >> 16;
+	key *= 0x85ebca6b;
+	key ^= key >> 13;
+	key *= 0xc2b2ae35;
+	key ^= key >> 16;
+	return key;
+}
+
+unsigned short pick_hashed_bucket(struct host * host, unsigned short dnum, unsigned int key)
+{
+	// Picks a destination bucket for destination "dnum" from a hash of a
+	// per-packet key. Reads only, so any thread can pick for any packet.
+	unsigned char (*table)[HASH_TABLE_SIZE] = __atomic_load_n(&host->hash_table, __ATOMIC_ACQUIRE);
+	if(dnum >= MAX_FLOWS) return 0;
+	return table[dnum][hash32(key) & (HASH_TABLE_SIZE - 1)];
+}
+
+unsigned int get_hash_key(struct iphdr * ip_hdr, struct udphdr * udph, int ip_payload_size)
+{
+	// Returns the per-packet key for hash mode. In sequence mode, UDP packets
+	// long enough to carry an iperf3 header use the 32 bit packet counter at
+	// IPERF_SEQ_OFFSET. With 64 bit counters (seq64), the low word of the
+	// big endian counter follows it instead. Everything else uses the IP ID.
+	int offset = hash_mode == HASH_SEQUENCE64 ? IPERF_SEQ_OFFSET + 4 : IPERF_SEQ_OFFSET;
+	unsigned int seq;
+	if(hash_mode >= HASH_SEQUENCE && udph &&
+	   ip_payload_size >= (int) (ip_hdr->ihl * 4 + sizeof(struct udphdr) + offset + sizeof(seq)))
+	{
+		memcpy(&seq, ((unsigned char *) (udph + 1)) + offset, sizeof(seq));
+		return ntohl(seq);
+	}
+	return ntohs(ip_hdr->id);
+}
+
+unsigned short port_translate(struct host * host, unsigned short sport, unsigned int saddr, unsigned int hash_key)
 {
 	// Main port translation function. Modifies a port given a source port
-	// and source address.
+	// and source address. hash_key is only used in hash mode.
 
 	if(sport < send_start_port || 
 	   sport > ((int) send_start_port) + MAX_FLOWS * MAX_TUNNELS_PER_FLOW)
@@ -275,11 +841,12 @@ unsigned short port_translate(unsigned short sport, unsigned int saddr)
 	   }
 
 	// Input rule
-	if(saddr != my_ip)
+	if(saddr != host->ip)
 		return ((sport - send_start_port) / MAX_TUNNELS_PER_FLOW) + send_start_port;
 	// Output rule
 	unsigned short dnum = sport - send_start_port;
-	return send_start_port + (unsigned short) pick_next_bucket(dnum) + dnum * MAX_TUNNELS_PER_FLOW;
+	unsigned short bucket = hash_mode ? pick_hashed_bucket(host, dnum, hash_key) : pick_next_bucket(host, dnum);
+	return send_start_port + bucket + dnum * MAX_TUNNELS_PER_FLOW;
 }
 
 // =================================================================================================
@@ -292,7 +859,7 @@ static int pkt_accept(char * message, struct nfq_q_handle *queue, struct nfqnl_m
 	return nfq_set_verdict(queue, ntohl(ph->packet_id), NF_ACCEPT, 0, NULL);
 }
 
-static int pkt_mangle(struct nfq_q_handle *queue, struct nfgenmsg *nfmsg, struct nfq_data *nfad, void * unused)
+static int pkt_mangle(struct nfq_q_handle *queue, struct nfgenmsg *nfmsg, struct nfq_data *nfad, struct host * host)
 {
 	// Main callback for nfqueue. Applies source/destination port mangling as
 	// described in the -h option.
@@ -343,9 +910,11 @@ static int pkt_mangle(struct nfq_q_handle *queue, struct nfgenmsg *nfmsg, struct
 		if(!(tcph = nfq_tcp_get_hdr(pktb)))
 			return pkt_accept("Could not parse TCP header. Accepting packet.\n", queue, ph);
 		sport = ntohs(tcph->th_sport);
-		if(sport == (new_sport = port_translate(sport, saddr)))
+		if(sport == (new_sport = port_translate(host, sport, saddr, hash_mode ? get_hash_key(ip_hdr, NULL, ip_payload_size) : 0)))
 			return pkt_accept("Source port unchanged. Accepting packet.\n", queue, ph);
 		if(verbose) printf("TCP packet %08X:%d->:%d packet now %08X:%d->:%d\n", saddr, sport, ntohs(tcph->th_dport), saddr, new_sport, ntohs(tcph->th_dport));
+		if(trace_hdr) trace_packet(host, saddr, sport, new_sport, ntohs(tcph->th_dport), ip_payload_size, IPPROTO_TCP);
+		if(tunnel_stats_file) count_tunnel_packet(host, saddr, sport, new_sport, ntohs(tcph->th_dport), ip_hdr, NULL, ip_payload_size);
 		tcph->th_sport=htons(new_sport);
 		tcph->check = 0;
 		if(calc_checksum) nfq_tcp_compute_checksum_ipv4(tcph, ip_hdr);
@@ -357,9 +926,11 @@ static int pkt_mangle(struct nfq_q_handle *queue, struct nfgenmsg *nfmsg, struct
 		if(!(udph = nfq_udp_get_hdr(pktb)))
 			return pkt_accept("Could not parse UDP header. Accepting packet.\n", queue, ph);
 		sport = ntohs(udph->uh_sport);
-		if(sport == (new_sport = port_translate(sport, saddr)))
+		if(sport == (new_sport = port_translate(host, sport, saddr, hash_mode ? get_hash_key(ip_hdr, udph, ip_payload_size) : 0)))
 			return pkt_accept("Source port unchanged. Accepting packet.\n", queue, ph);
 		if(verbose) printf("UDP packet %08X:%d->:%d packet now %08X:%d->:%d\n", saddr, sport, ntohs(udph->uh_dport), saddr, new_sport, ntohs(udph->uh_dport));
+		if(trace_hdr) trace_packet(host, saddr, sport, new_sport, ntohs(udph->uh_dport), ip_payload_size, IPPROTO_UDP);
+		if(tunnel_stats_file) count_tunnel_packet(host, saddr, sport, new_sport, ntohs(udph->uh_dport), ip_hdr, udph, ip_payload_size);
 		udph->uh_sport=htons(new_sport);
 		udph->check = 0;
 		if(calc_checksum) nfq_udp_compute_checksum_ipv4(udph, ip_hdr);
@@ -368,47 +939,245 @@ static int pkt_mangle(struct nfq_q_handle *queue, struct nfgenmsg *nfmsg, struct
 	return pkt_accept(NULL, queue, ph);
 }
 
-int main(int argc, char **argv)
+static int pkt_callback(struct nfq_q_handle *queue, struct nfgenmsg *nfmsg, struct nfq_data *nfad, void * data)
 {
-	struct nfq_handle *h;
-	struct nfq_q_handle *qh;
-	int fd;
-	int rv;
-	char buf[4096] __attribute__ ((aligned));
+	// Callback registered with nfqueue. data is the host owning the queue.
+	// Mangles the packet, then records how long it spent queued if latency
+	// instrumentation is on.
+	struct host * host = (struct host *) data;
+	int rv = pkt_mangle(queue, nfmsg, nfad, host);
+	if(latency_file) record_latency(host, nfad);
+	return rv;
+}
 
-	// Parse user args and initialize variables
-	if(parse_args(argc, argv))
+// =================================================================================================
+// LOW LATENCY SETUP
+// =================================================================================================
+void tune_packet_thread(int thread_cpu)
+{
+	// Applies CPU pinning and real-time scheduling to the calling thread.
+	// Failures are reported but not fatal.
+	if(thread_cpu >= 0)
 	{
-		fprintf(stderr, "Invalid options. Exiting.\n");
-		fprintf(stderr, "%s -h for usage information.\n", argv[0]);
+		cpu_set_t set;
+		CPU_ZERO(&set);
+		CPU_SET(thread_cpu, &set);
+		if(sched_setaffinity(0, sizeof(set), &set)) printf("Failed to pin packet thread to CPU %d!\n", thread_cpu);
+	}
+	if(fifo_priority)
+	{
+		struct sched_param param = { .sched_priority = fifo_priority };
+		if(sched_setscheduler(0, SCHED_FIFO, &param)) printf("Failed to set SCHED_FIFO priority %d!\n", fifo_priority);
+	}
+}
+
+void tune_queue_socket(int fd)
+{
+	// Applies socket options to a queue socket. Failures are reported but not
+	// fatal. SO_TIMESTAMP makes the kernel timestamp every received packet,
+	// which latency measurement needs; without it most packets arrive
+	// without a timestamp. Low latency mode's busy polling is done by epoll,
+	// since netlink sockets don't support SO_BUSY_POLL.
+	int one = 1;
+	if(latency_file && setsockopt(fd, SOL_SOCKET, SO_TIMESTAMP, &one, sizeof(one))) printf("Failed to set SO_TIMESTAMP!\n");
+	if(!low_latency) return;
+	if(setsockopt(fd, SOL_NETLINK, NETLINK_NO_ENOBUFS, &one, sizeof(one))) printf("Failed to set NETLINK_NO_ENOBUFS!\n");
+}
+
+// =================================================================================================
+// HOST SETUP
+// =================================================================================================
+int parse_host_spec(struct host * host, char * spec)
+{
+	// Parses a consolidated mode host given as "netns,ip,weight_file".
+	char * ip = strchr(spec, ',');
+	char * file = ip ? strchr(ip + 1, ',') : NULL;
+	if(!file)
+	{
+		printf("Invalid host %s! Hosts should be given as netns,ip,weight_file.\n", spec);
 		return -1;
 	}
-	bzero(weights, sizeof(weights));
-	bzero(curr_allocs, sizeof(curr_allocs));
+	*ip++ = '\0';
+	*file++ = '\0';
+	host->netns = spec;
+	host->ip = (unsigned int) strtoul(ip, NULL, 10);
+	host->weight_file = file;
+	if(!host->ip || !*file)
+	{
+		printf("Invalid IP and/or weight file for host in namespace %s!\n", spec);
+		return -1;
+	}
+	return 0;
+}
+
+int open_queue(struct host * host)
+{
+	// Opens a host's NetFilter queue. If the host has a network namespace,
+	// the queue socket is created inside it and the daemon then returns to its
+	// own namespace. The socket stays bound to the host's namespace.
+	int self_ns = -1;
+	int host_ns = -1;
+	int success = 0;
+	if(host->netns)
+	{
+		if((self_ns = open("/proc/thread-self/ns/net", O_RDONLY)) < 0)
+			FAIL("Failed to open the daemon's network namespace.\n");
+		if((host_ns = open(host->netns, O_RDONLY)) < 0 || setns(host_ns, CLONE_NEWNET))
+		{
+			fprintf(stderr, "Failed to enter network namespace %s\n", host->netns);
+			if(host_ns >= 0) close(host_ns);
+			close(self_ns);
+			return -1;
+		}
+	}
 
 	// Set up NetFilter Queue Handle
 	// Setup source code adapted from libnetfilter_queue/utils/nf-queue.c
-	printf("Setting up NetFilter Queue Handle.\n");
-	int success = 0;
-	if(!(h = nfq_open()))
+	if(!(host->h = nfq_open()))
 		fprintf(stderr, "Error during nfq_open()\n");
-	else if(nfq_bind_pf(h, AF_INET) < 0)
+	else if(nfq_bind_pf(host->h, AF_INET) < 0)
 		fprintf(stderr, "Failed to bind queue handler for AF_INET. Error during nfq_bind_pf()\n");
-	else if(!(qh = nfq_create_queue(h,  queue_num, &pkt_mangle, NULL)))
+	else if(!(host->qh = nfq_create_queue(host->h,  queue_num, &pkt_callback, host)))
 		fprintf(stderr, "Error during nfq_create_queue()! Failed to bind socket to queue %d\n", queue_num);
-	else if(nfq_set_mode(qh, NFQNL_COPY_PACKET, 0xffff) < 0)
+	else if(nfq_set_mode(host->qh, NFQNL_COPY_PACKET, 0xffff) < 0)
 		fprintf(stderr, "Can't set packet_copy mode\n");
 	else success = 1;
-	if(!success)
+
+	if(host->netns)
+	{
+		if(setns(self_ns, CLONE_NEWNET))
+		{
+			fprintf(stderr, "Failed to return from network namespace %s\n", host->netns);
+			success = 0;
+		}
+		close(host_ns);
+		close(self_ns);
+	}
+	if(!success) return -1;
+
+	// Increase queue sizes to avoid drops.
+	nfq_set_queue_maxlen(host->qh, QUEUE_MAXLEN);
+	nfnl_rcvbufsiz(nfq_nfnlh(host->h), RECV_BUF_SIZE);
+	host->fd = nfq_fd(host->h);
+	tune_queue_socket(host->fd);
+	return 0;
+}
+
+// =================================================================================================
+// WORKERS
+// =================================================================================================
+void* run_worker(void * arg)
+{
+	// Serves the queues of every host assigned to this worker from one epoll
+	// loop. Worker N owns hosts N, N + num_workers, N + 2 * num_workers...
+	// Busy polls instead of blocking if low_latency is set.
+	int index = (int) (long) arg;
+	int epfd;
+	int n;
+	int rv;
+	char buf[4096] __attribute__ ((aligned));
+	struct epoll_event events[MAX_HOSTS];
+
+	if((epfd = epoll_create1(0)) < 0)
+	{
+		fprintf(stderr, "Worker %d failed to create epoll instance.\n", index);
+		return NULL;
+	}
+	for(int i = index; i < num_hosts; i += num_workers)
+	{
+		struct epoll_event ev = { .events = EPOLLIN, .data.ptr = &hosts[i] };
+		if(epoll_ctl(epfd, EPOLL_CTL_ADD, hosts[i].fd, &ev))
+			fprintf(stderr, "Worker %d failed to watch queue of host %d.\n", index, i);
+	}
+	tune_packet_thread(cpu >= 0 ? cpu + index : -1);
+
+	for (;;) {
+		if ((n = epoll_wait(epfd, events, MAX_HOSTS, low_latency ? 0 : -1)) < 0) {
+			if(errno == EINTR) continue;
+			if(verbose) printf("Worker %d epoll failed.\n", index);
+			break;
+		}
+		for(int e = 0; e < n; e++)
+		{
+			// Read up to a batch of packets so one busy host can't starve
+			// the others. Epoll reports the host again if more are waiting.
+			struct host * host = (struct host *) events[e].data.ptr;
+			for(int k = 0; k < RECV_BATCH; k++) {
+				if ((rv = recv(host->fd, buf, sizeof(buf), MSG_DONTWAIT)) >= 0) {
+					if(latency_file) clock_gettime(CLOCK_REALTIME, &recv_time);
+					nfq_handle_packet(host->h, buf, rv);
+					if(pktb != NULL)
+					{
+						pktb_free(pktb);
+						pktb = NULL;
+					}
+					continue;
+				}
+				if (errno == ENOBUFS) {
+					host->latency.enobufs++;
+					if(verbose) fprintf(stderr, "Losing packets! See doxygen documentation of netfilter_queue on how to fix.\n");
+					continue;
+				}
+				if (errno != EAGAIN && errno != EWOULDBLOCK && verbose)
+					printf("Packet recv failed.\n");
+				break;
+			}
+		}
+	}
+	close(epfd);
+	return NULL;
+}
+
+// =================================================================================================
+// MAIN
+// =================================================================================================
+int main(int argc, char **argv)
+{
+	pthread_t workers[MAX_WORKERS];
+
+	// Parse user args and initialize variables
+	if(parse_args(argc, argv))
+	{
+		fprintf(stderr, "Invalid options. Exiting.\n");
+		fprintf(stderr, "%s -h for usage information.\n", argv[0]);
+		return -1;
+	}
+	if(!(hosts = calloc(num_hosts ? num_hosts : 1, sizeof(struct host))))
+		FAIL("Failed to allocate hosts.\n");
+	if(!num_hosts)
+	{
+		hosts[0].ip = my_ip;
+		hosts[0].weight_file = weight_file;
+		num_hosts = 1;
+	}
+	else for(int i = 0; i < num_hosts; i++)
+		if(parse_host_spec(&hosts[i], host_specs[i]))
+			return -1;
+	for(int i = 0; i < num_hosts; i++)
+	{
+		hosts[i].index = i;
+		if(tunnel_stats_file && (!(hosts[i].recv = calloc(MAX_FLOWS, sizeof(*hosts[i].recv))) ||
+		                         !(hosts[i].sent = calloc(MAX_FLOWS, sizeof(*hosts[i].sent)))))
+			FAIL("Failed to allocate tunnel statistics.\n");
+		if(!hash_mode) continue;
+		if(!(hosts[i].hash_tables = calloc(2, sizeof(*hosts[i].hash_tables))))
+			FAIL("Failed to allocate hash tables.\n");
+		hosts[i].hash_table = hosts[i].hash_tables[0];
+	}
+	if(num_workers > num_hosts) num_workers = num_hosts;
+	if(trace_file && open_trace())
+		return -1;
+
+	printf("Setting up NetFilter Queue Handles.\n");
+	for(int i = 0; i < num_hosts; i++) if(open_queue(&hosts[i]))
 	{
 		printf("Failed. %s -h for usage information.", argv[0]);
 		return -1;
 	}
 
-	// Increase speed of process and queue sizes to avoid drops.
+	// Increase speed of process to avoid drops.
 	if(nice(-20)) printf("Failed to set process priority!\n");
-	nfq_set_queue_maxlen(qh, QUEUE_MAXLEN);
-	nfnl_rcvbufsiz(nfq_nfnlh(h), RECV_BUF_SIZE);
+	if(low_latency && mlockall(MCL_CURRENT | MCL_FUTURE)) printf("Failed to lock process memory!\n");
 
 	// Start up weight reading thread
     pthread_t id;
@@ -417,29 +1186,20 @@ int main(int argc, char **argv)
 
 	printf("Intercepting packets on queue %d.\n", queue_num);
 
-	fd = nfq_fd(h);
-	for (;;) {
-		if ((rv = recv(fd, buf, sizeof(buf), 0)) >= 0) {
-			nfq_handle_packet(h, buf, rv);
-			if(pktb != NULL)
-			{
-				pktb_free(pktb);
-				pktb = NULL;
-			}
-		
+	// Workers are spawned after the weight thread so it keeps default
+	// scheduling and can't be starved by busy polling workers. This thread
+	// runs worker 0.
+	for(int w = 1; w < num_workers; w++)
+		if(pthread_create(&workers[w], NULL, run_worker, (void *) (long) w))
+			FAIL("Failed to spawn worker thread.\n");
+	run_worker((void *) 0);
+	for(int w = 1; w < num_workers; w++) pthread_join(workers[w], NULL);
 
-			continue;
-		}
-		if (rv < 0 && errno == ENOBUFS) {
-			if(verbose) fprintf(stderr, "Losing packets! See doxygen documentation of netfilter_queue on how to fix.\n");
-			continue;
-		}
-		if(verbose) printf("Packet recv failed.\n");
-		break;
+	for(int i = 0; i < num_hosts; i++)
+	{
+		nfq_destroy_queue(hosts[i].qh);
+		nfq_close(hosts[i].h);
 	}
-
-	nfq_destroy_queue(qh);
-	nfq_close(h);
 	return 0;
 }
 
@@ -1,6 +1,10 @@
-from typing import Tuple, List
+from typing import Tuple, List, Dict
 from mininet.net import Mininet
+from array import array
 import os
+import struct
+import subprocess
+import sys
 
 # For each host's iperf port modification. Must match weighted_tunnels.c!!
 MAX_TUNNELS_PER_FLOW = 16
@@ -8,6 +12,29 @@ MAX_FLOWS = 128  # per host!
 DEFAULT_RECV_START_PORT = 10000
 DEFAULT_SEND_START_PORT = 20000
 FLOW_WEIGHTS_DIR = './flow_weights'
+LATENCY_BUCKETS = 40  # Must match weighted_tunnels.c!!
+
+# Binary packet trace layout. Must match weighted_tunnels.c!!
+TRACE_MAGIC = b'WTTRACE1'
+TRACE_HEADER_FORMAT = '<8sIIQQ32x'
+TRACE_RECORD_FORMAT = '<QHHHHBBBB4x'
+TRACE_FIELDS = (
+    ('timestamp_ns', 'Q'),
+    ('host', 'H'),
+    ('orig_port', 'H'),
+    ('new_port', 'H'),
+    ('length', 'H'),
+    ('direction', 'B'),
+    ('tunnel', 'B'),
+    ('protocol', 'B'),
+    ('node', 'B'),
+)
+TRACE_OUTGOING = 0
+TRACE_INCOMING = 1
+
+# Stateless hash mode. Must match weighted_tunnels.c!!
+HASH_TABLE_BITS = 10
+HASH_MODES = ('id', 'seq', 'seq64')
 
 OVS15_CALL = 'ovs-ofctl -O OpenFlow15'
 
@@ -33,6 +60,15 @@ def ip_to_int(ip: str) -> int:
         i = i * 256 + int(x)
     return i
 
+
+def get_daemon_path(host_num: int, extension: str) -> str:
+    """
+    Returns the default path of a file written by the daemon for a host. If
+    host_num is None, returns the path for a consolidated daemon.
+    """
+    name = 'consolidated' if host_num is None else h(host_num)
+    return FLOW_WEIGHTS_DIR + f'/{name}.{extension}'
+
 # ==============================================================================
 # MININET INTERFACING FUNCTIONS
 # ==============================================================================
@@ -180,6 +216,17 @@ def start_daemon(
         weight_path: str = None,
         stdout: str = '/dev/null',
         stderr: str = '/dev/null',
+        cpu: int = None,
+        fifo_priority: int = None,
+        low_latency: bool = False,
+        measure_latency: bool = False,
+        latency_path: str = None,
+        trace: bool = False,
+        trace_path: str = None,
+        trace_records: int = None,
+        hash_mode: str = None,
+        tunnel_stats: bool = False,
+        tunnel_stats_path: str = None,
 ) -> None:
     """
     Mangles source/destination ports of UDP packets being exchanged by
@@ -195,11 +242,57 @@ def start_daemon(
         recv_start_port: Start port for receiver iperf sessions
         send_start_port: Start port for sender iperf sessions
         weight_path: Path to the weight file used by this port mod session.
+        cpu: If set, pins the daemon's packet thread to this CPU.
+        fifo_priority:
+            If set, runs the daemon's packet thread under SCHED_FIFO with
+            this priority (1-99).
+        low_latency:
+            Polls the queue without blocking, locks daemon memory and sets
+            NETLINK_NO_ENOBUFS. Burns a full CPU; best combined with cpu.
+        measure_latency:
+            Records a histogram of the time each packet spends queued in
+            the daemon. Read it with get_latency_histogram.
+        latency_path: Path to the latency histogram file.
+        trace:
+            Writes a fixed-size binary record of every translated packet to
+            a ring buffer. Read it with read_trace. Unlike verbose mode, this
+            is cheap enough to leave on at line rate.
+        trace_path: Path to the trace ring buffer file.
+        trace_records:
+            Number of records the ring buffer holds before overwriting the
+            oldest. Each record is 24 bytes.
+        hash_mode:
+            If set, tunnels are chosen statelessly by hashing each packet's
+            IP ID ("id") or iperf3 UDP sequence number ("seq") through a
+            weight-proportional lookup table, instead of by the deficit
+            scheduler. Use "seq64" for iperf3 clients run with
+            --udp-counters-64bit. See split_error.py for the accuracy cost.
+        tunnel_stats:
+            Counts packets sent and received on each tunnel, and tracks
+            reordering of incoming iperf3 UDP flows. Read it with
+            read_tunnel_stats and get_tunnel_report.
+        tunnel_stats_path: Path to the tunnel statistics file.
 
     """
     assert_start_ports(recv_start_port, send_start_port)
     if weight_path is None:
         weight_path = FLOW_WEIGHTS_DIR + f'/h{host_num}.txt'
+    if latency_path is None:
+        latency_path = get_daemon_path(host_num, 'latency')
+    if trace_path is None:
+        trace_path = get_daemon_path(host_num, 'trace')
+    if tunnel_stats_path is None:
+        tunnel_stats_path = get_daemon_path(host_num, 'tunnels')
+    extra_args = get_daemon_options(
+        cpu=cpu,
+        fifo_priority=fifo_priority,
+        low_latency=low_latency,
+        latency_path=latency_path if measure_latency else None,
+        trace_path=trace_path if trace else None,
+        trace_records=trace_records,
+        hash_mode=hash_mode,
+        tunnel_stats_path=tunnel_stats_path if tunnel_stats else None,
+    )
     # Modify ports
     host = net.get(h(host_num))
     ip = get_ip(net, host_num, switch_num)
@@ -211,6 +304,7 @@ def start_daemon(
               f'-r {recv_start_port} ' \
               f'-s {send_start_port} ' \
               f'-q 58 ' \
+              f'{extra_args}' \
               f'-v > iperf_results/d{host_num}.txt &'
     elif False:
         cmd = f'./weighted_tunnels ' \
@@ -219,6 +313,7 @@ def start_daemon(
               f'-r {recv_start_port} ' \
               f'-s {send_start_port} ' \
               f'-q 58 ' \
+              f'{extra_args}' \
               f'-v > iperf_results/d{host_num}.txt &'
     else:
         cmd = f'./weighted_tunnels ' \
@@ -227,18 +322,182 @@ def start_daemon(
                 f'-r {recv_start_port} ' \
                 f'-s {send_start_port} ' \
                 f'-q 58 ' \
+                f'{extra_args}' \
                 f'1> {stdout} 2> {stderr} & '
 
     host.cmd(cmd)
     print(cmd)
-
-    # Use iptables to send packets to port modification
+    add_queue_rules(net, host_num)
+
+
+def get_daemon_options(
+        cpu: int = None,
+        fifo_priority: int = None,
+        low_latency: bool = False,
+        latency_path: str = None,
+        trace_path: str = None,
+        trace_records: int = None,
+        hash_mode: str = None,
+        tunnel_stats_path: str = None,
+) -> str:
+    """
+    Returns the optional daemon command line arguments shared by
+    start_daemon and start_consolidated_daemon. latency_path, trace_path and
+    tunnel_stats_path enable latency measurement, tracing and tunnel
+    statistics respectively when set.
+    """
+    args = ''
+    if cpu is not None:
+        args += f'-a {cpu} '
+    if fifo_priority is not None:
+        args += f'-f {fifo_priority} '
+    if low_latency:
+        args += '-l '
+    if latency_path is not None:
+        args += f'-H {latency_path} '
+    if trace_path is not None:
+        args += f'-t {trace_path} '
+    if trace_records is not None:
+        args += f'-T {trace_records} '
+    if hash_mode is not None:
+        assert hash_mode in HASH_MODES, f'Hash mode must be in {HASH_MODES}!'
+        args += f'-x {hash_mode} '
+    if tunnel_stats_path is not None:
+        args += f'-R {tunnel_stats_path} '
+    return args
+
+
+def add_queue_rules(net: Mininet, host_num: int) -> None:
+    """ Uses iptables to send a host's UDP packets to its daemon's queue. """
+    host = net.get(h(host_num))
     host.cmd('iptables -F OUTPUT')
     host.cmd('iptables -A OUTPUT -p udp -j NFQUEUE --queue-num 58')
     host.cmd('iptables -F INPUT')
     host.cmd('iptables -A INPUT -p udp -j NFQUEUE --queue-num 58')
 
 
+def start_consolidated_daemon(
+        net: Mininet,
+        host_nums: List[int],
+        switch_nums: List[int] = None,
+        workers: int = 1,
+        recv_start_port: int = DEFAULT_RECV_START_PORT,
+        send_start_port: int = DEFAULT_SEND_START_PORT,
+        weight_paths: List[str] = None,
+        stdout: str = '/dev/null',
+        stderr: str = '/dev/null',
+        cpu: int = None,
+        fifo_priority: int = None,
+        low_latency: bool = False,
+        measure_latency: bool = False,
+        latency_path: str = None,
+        trace: bool = False,
+        trace_path: str = None,
+        trace_records: int = None,
+        hash_mode: str = None,
+        tunnel_stats: bool = False,
+        tunnel_stats_path: str = None,
+) -> subprocess.Popen:
+    """
+    Starts a single daemon that mangles ports for every host in host_nums.
+    The daemon runs in the root namespace and binds a queue inside each
+    host's network namespace, so one process and a few threads replace one
+    process per host. Port numbering and weights work exactly as with
+    start_daemon; set_tunnel_weights is used the same way.
+    Requires a weighted_tunnels executable in the current path.
+
+    Unlike per-host daemons, this daemon is not stopped by net.stop(). Returns
+    its process, which must be passed to stop_consolidated_daemon when done.
+
+    params:
+        net: Mininet newtork.
+        host_nums: Hosts to mod ports.
+        switch_nums:
+            Switch each host is connected to. If not set, assumed to be
+            the same numbers as the hosts.
+        workers:
+            Number of packet threads. Hosts are split evenly between them.
+            Each thread serves its hosts from one epoll loop.
+        recv_start_port: Start port for receiver iperf sessions
+        send_start_port: Start port for sender iperf sessions
+        weight_paths:
+            Path to the weight file for each host. If not set, uses the
+            same paths as start_daemon.
+        cpu: If set, pins worker N to CPU cpu + N.
+        fifo_priority, low_latency, measure_latency, trace, trace_records,
+        hash_mode, tunnel_stats:
+            As in start_daemon, applied to every worker.
+        latency_path:
+            Path to the latency histogram file, which covers all hosts.
+            Read it with get_latency_histogram(None).
+        trace_path:
+            Path to the trace ring buffer file, which covers all hosts. Read
+            it with read_trace(None). The "node" field gives each packet's
+            index in host_nums. Tracing requires a single worker.
+        tunnel_stats_path:
+            Path to the tunnel statistics file, which covers all hosts.
+            Read it with read_tunnel_stats(None); each host's statistics
+            are under its index in host_nums.
+    """
+    assert_start_ports(recv_start_port, send_start_port)
+    assert not trace or workers == 1, 'Tracing requires a single worker!'
+    if switch_nums is None:
+        switch_nums = [None] * len(host_nums)
+    if weight_paths is None:
+        weight_paths = [FLOW_WEIGHTS_DIR + f'/h{n}.txt' for n in host_nums]
+    if latency_path is None:
+        latency_path = get_daemon_path(None, 'latency')
+    if trace_path is None:
+        trace_path = get_daemon_path(None, 'trace')
+    if tunnel_stats_path is None:
+        tunnel_stats_path = get_daemon_path(None, 'tunnels')
+
+    cmd = './weighted_tunnels '
+    for host_num, switch_num, weight_path in zip(
+        host_nums, switch_nums, weight_paths
+    ):
+        netns = f'/proc/{net.get(h(host_num)).pid}/ns/net'
+        ip = ip_to_int(get_ip(net, host_num, switch_num))
+        cmd += f'-m {netns},{ip},{weight_path} '
+    cmd += f'-j {workers} ' \
+           f'-r {recv_start_port} ' \
+           f'-s {send_start_port} ' \
+           f'-q 58 '
+    cmd += get_daemon_options(
+        cpu=cpu,
+        fifo_priority=fifo_priority,
+        low_latency=low_latency,
+        latency_path=latency_path if measure_latency else None,
+        trace_path=trace_path if trace else None,
+        trace_records=trace_records,
+        hash_mode=hash_mode,
+        tunnel_stats_path=tunnel_stats_path if tunnel_stats else None,
+    )
+    cmd += f'1> {stdout} 2> {stderr}'
+
+    # Runs in the root namespace; the daemon enters each host's namespace.
+    # exec makes the daemon itself the child process.
+    daemon = subprocess.Popen(f'exec {cmd}', shell=True)
+    print(cmd)
+    for host_num in host_nums:
+        add_queue_rules(net, host_num)
+    return daemon
+
+
+def stop_consolidated_daemon(daemon: subprocess.Popen) -> None:
+    """
+    Stops a daemon started with start_consolidated_daemon and waits for it to
+    exit, releasing the host namespaces it holds open. Does nothing if it has
+    already exited.
+
+    params:
+        daemon: Process returned by start_consolidated_daemon.
+    """
+    if daemon.poll() is None:
+        daemon.terminate()
+    daemon.wait()
+
+
 def get_iperf_commands(
     net: Mininet,
     client_num: int,
@@ -382,3 +641,268 @@ def add_flow_tunnel(
             from_switch=from_switch,
             filter=filter
         )
+
+
+# ==============================================================================
+# DAEMON STATISTICS
+# ==============================================================================
+
+
+def get_latency_histogram(
+    host_num: int,
+    latency_path: str = None,
+) -> Dict[str, object]:
+    """
+    Reads the latency histogram written by a daemon started with
+    measure_latency=True. The histogram is rewritten once per second. A
+    consolidated daemon writes one histogram covering all of its hosts.
+
+    Returns a dictionary with the counters "packets", "no_kernel_timestamp",
+    "bad_kernel_timestamp", "enobufs", "max_ns" and "fallback_max_ns", and two
+    histograms, each a list of (min_ns, max_ns, packet_count) tuples:
+        buckets: Packets that spent min_ns <= t < max_ns between being queued
+                 by the kernel and receiving a verdict from the daemon. Only
+                 this histogram bounds queue residence time.
+        fallback_buckets: Packets without a usable kernel timestamp, timed
+                          from when the daemon read them instead. This only
+                          covers the daemon's own processing time.
+    The daemon turns on kernel timestamping of received packets, so incoming
+    packets normally land in buckets. Packets counted in "no_kernel_timestamp"
+    had no kernel timestamp, which is usual for locally generated packets. Packets counted in
+    "bad_kernel_timestamp" had one in the future or over a second old, such
+    as a TCP delivery time. Both are in fallback_buckets.
+
+    params:
+        host_num: Host running the daemon. None for a consolidated daemon.
+        latency_path: Path to the latency histogram file.
+    """
+    if latency_path is None:
+        latency_path = get_daemon_path(host_num, 'latency')
+    stats = {'buckets': [], 'fallback_buckets': []}
+    with open(latency_path) as f:
+        for line in f.read().split('\n'):
+            if not line:
+                continue
+            fields = line.split(',')
+            if fields[0] in ('bucket', 'fallback_bucket'):
+                b = int(fields[1])
+                min_ns = 0 if b == 0 else 2 ** (b - 1)
+                stats[fields[0] + 's'].append(
+                    (min_ns, 2 ** b, int(fields[2]))
+                )
+            else:
+                stats[fields[0]] = int(fields[1])
+    return stats
+
+
+def latency_percentile(
+    stats: Dict[str, object],
+    percentile: float,
+    fallback: bool = False,
+) -> int:
+    """
+    Returns an upper bound, in nanoseconds, on the given percentile (0-100) of
+    daemon queue residence time from a get_latency_histogram result. Returns 0
+    if no packets were recorded.
+
+    params:
+        stats: get_latency_histogram result.
+        percentile: Percentile to bound.
+        fallback:
+            Uses the histogram of packets without a usable kernel timestamp
+            instead. This bounds daemon processing time, not queue
+            residence time.
+    """
+    buckets = stats['fallback_buckets' if fallback else 'buckets']
+    max_ns = stats['fallback_max_ns' if fallback else 'max_ns']
+    total = sum(b[2] for b in buckets)
+    target = total * percentile / 100
+    seen = 0
+    for min_ns, bucket_max_ns, count in buckets:
+        seen += count
+        if count and seen >= target:
+            return min(bucket_max_ns, max_ns + 1)
+    return 0
+
+
+def read_trace(host_num: int, trace_path: str = None) -> Dict[str, array]:
+    """
+    Decodes the packet trace ring buffer written by a daemon started with
+    trace=True. May be called while the daemon is running.
+
+    Returns a dictionary mapping each field name to an array with one entry
+    per packet, oldest first. Fields are:
+        timestamp_ns: Wall clock time the packet was translated.
+        host: Destination host for outgoing packets, source host for
+              incoming packets.
+        orig_port, new_port: Source port before and after translation.
+        length: IP packet length in bytes.
+        direction: TRACE_OUTGOING or TRACE_INCOMING.
+        tunnel: Tunnel the packet was sent or received on.
+        protocol: IP protocol number.
+        node: Index of the host that saw the packet among the hosts served
+              by a consolidated daemon. Always 0 for start_daemon.
+    Only the most recent trace_records packets are kept by the daemon. Once
+    the ring buffer is full, the oldest of them is skipped as it may be
+    partly overwritten.
+
+    params:
+        host_num: Host running the daemon. None for a consolidated daemon.
+        trace_path: Path to the trace ring buffer file.
+    """
+    if trace_path is None:
+        trace_path = get_daemon_path(host_num, 'trace')
+    header_size = struct.calcsize(TRACE_HEADER_FORMAT)
+    record_size = struct.calcsize(TRACE_RECORD_FORMAT)
+    with open(trace_path, 'rb') as f:
+        header = f.read(header_size)
+        magic, rsize, _, capacity, head = \
+            struct.unpack(TRACE_HEADER_FORMAT, header)
+        assert magic == TRACE_MAGIC, f'{trace_path} is not a packet trace!'
+        assert rsize == record_size, 'Trace record size mismatch!'
+        data = f.read(capacity * record_size)
+        f.seek(0)
+        end_head = struct.unpack(TRACE_HEADER_FORMAT, f.read(header_size))[4]
+
+    # Records the daemon wrote over while we were reading are discarded. So
+    # is the oldest slot, which the daemon may be overwriting before it
+    # publishes the next head.
+    start = max(0, end_head - capacity + 1)
+    count = max(0, head - start)
+    first = start % capacity
+    records = memoryview(data)[first * record_size:
+                               (first + count) * record_size].tobytes()
+    if first + count > capacity:  # Wrapped around the end of the ring
+        records += data[:(first + count - capacity) * record_size]
+
+    # Each byte of a field is a strided slice of the records. Interleaving
+    # them gives the field's column, without unpacking records one by one.
+    trace = {}
+    offset = 0
+    for name, code in TRACE_FIELDS:
+        size = struct.calcsize(code)
+        raw = bytearray(count * size)
+        for i in range(size):
+            raw[i::size] = records[offset + i::record_size]
+        column = array(code, bytes(raw))
+        if sys.byteorder != 'little':
+            column.byteswap()
+        trace[name] = column
+        offset += size
+    return trace
+
+
+def read_tunnel_stats(
+    host_num: int,
+    tunnel_stats_path: str = None,
+) -> Dict[str, Dict[tuple, Dict[str, int]]]:
+    """
+    Reads the tunnel statistics written by a daemon started with
+    tunnel_stats=True. The file is rewritten once per second.
+
+    Returns a dictionary with three entries, each mapping a key to a
+    dictionary of counters:
+        sent: (node, dst, tunnel) -> packets, bytes
+        received: (node, src, tunnel) -> packets, bytes, out_of_order,
+                  duplicates, reorder_depth_sum, reorder_depth_max
+        flows: (node, src) -> sequenced, duplicates, expected, gaps,
+               restarts, first_seq, max_seq, lost, loss_rate
+    node is the host's index in a consolidated daemon and 0 otherwise. src
+    and dst are the other host of the flow. Out of order packets arrived
+    with a lower iperf3 sequence number than one already received from the
+    same source; reorder depth is how far behind they were. Duplicates
+    repeated the highest sequence number received.
+
+    Flow entries are measured by the receiver alone from iperf3 sequence
+    numbers. expected counts every sequence number spanned by the flow's
+    iperf3 sessions, and lost is how many of them never arrived. restarts
+    counts sessions after the first, found by sequence numbers falling back
+    near 1 with a later iperf3 send timestamp. gaps counts jumps of more than one
+    sequence number, whether from loss or reordering. first_seq and max_seq
+    cover the current session.
+
+    params:
+        host_num: Host running the daemon. None for a consolidated daemon.
+        tunnel_stats_path: Path to the tunnel statistics file.
+    """
+    if tunnel_stats_path is None:
+        tunnel_stats_path = get_daemon_path(host_num, 'tunnels')
+    names = {
+        'sent': ('packets', 'bytes'),
+        'recv': ('packets', 'bytes', 'out_of_order', 'duplicates',
+                 'reorder_depth_sum', 'reorder_depth_max'),
+        'flow': ('sequenced', 'duplicates', 'expected', 'gaps', 'restarts',
+                 'first_seq', 'max_seq'),
+    }
+    stats = {'sent': {}, 'received': {}, 'flows': {}}
+    with open(tunnel_stats_path) as f:
+        for line in f.read().split('\n'):
+            if not line:
+                continue
+            kind, *fields = line.split(',')
+            fields = [int(x) for x in fields]
+            key_len = 2 if kind == 'flow' else 3
+            key, values = tuple(fields[:key_len]), fields[key_len:]
+            entry = {'sent': 'sent', 'recv': 'received', 'flow': 'flows'}[kind]
+            stats[entry][key] = dict(zip(names[kind], values))
+    for flow in stats['flows'].values():
+        # Duplicates of older packets look reordered, so never go below 0
+        unique = flow['sequenced'] - flow['duplicates']
+        flow['lost'] = max(0, flow['expected'] - unique)
+        flow['loss_rate'] = flow['lost'] / flow['expected']
+    return stats
+
+
+def get_tunnel_report(
+    sender_stats: Dict[str, Dict[tuple, Dict[str, int]]],
+    receiver_stats: Dict[str, Dict[tuple, Dict[str, int]]],
+    src_host: int,
+    dst_host: int,
+    sender_node: int = 0,
+    receiver_node: int = 0,
+) -> Dict[int, Dict[str, float]]:
+    """
+    Combines the read_tunnel_stats results of a flow's sender and receiver
+    into per-tunnel delivery, loss and reordering. Loss is the difference
+    between packets the sender's daemon put on a tunnel and packets the
+    receiver's daemon took off it, so it includes packets still in flight.
+    The receiver's own measure of the whole flow's loss is in the "flows"
+    entry of its read_tunnel_stats result.
+
+    Returns a dictionary mapping each tunnel to its sent, received and lost
+    packets, loss_rate, received bytes, out_of_order and duplicate packets
+    and mean and max reorder depth.
+
+    params:
+        sender_stats, receiver_stats: read_tunnel_stats results.
+        src_host, dst_host: Hosts sending and receiving the flow.
+        sender_node, receiver_node:
+            Index of the sender and receiver in a consolidated daemon.
+    """
+    report = {}
+    for tunnel in range(MAX_TUNNELS_PER_FLOW):
+        sent = sender_stats['sent'].get(
+            (sender_node, dst_host, tunnel), {'packets': 0, 'bytes': 0}
+        )
+        recv = receiver_stats['received'].get(
+            (receiver_node, src_host, tunnel), None
+        )
+        if not sent['packets'] and recv is None:
+            continue
+        recv = recv or {'packets': 0, 'bytes': 0, 'out_of_order': 0,
+                        'duplicates': 0, 'reorder_depth_sum': 0,
+                        'reorder_depth_max': 0}
+        lost = sent['packets'] - recv['packets']
+        report[tunnel] = {
+            'sent': sent['packets'],
+            'received': recv['packets'],
+            'lost': lost,
+            'loss_rate': lost / sent['packets'] if sent['packets'] else 0,
+            'received_bytes': recv['bytes'],
+            'out_of_order': recv['out_of_order'],
+            'duplicates': recv['duplicates'],
+            'mean_reorder_depth': recv['reorder_depth_sum'] /
+            recv['out_of_order'] if recv['out_of_order'] else 0,
+            'max_reorder_depth': recv['reorder_depth_max'],
+        }
+    return report